@@ -0,0 +1,143 @@
+import gzip
+import json
+import os
+import zlib
+
+import discord
+
+from registry import normalize_name
+from rest import gather_limited
+from store import get_store
+
+__all__ = ['Archive', 'get_archive', 'message_record']
+
+# Channels archived at once. Each one is a stream of history requests.
+ARCHIVE_LIMIT = 4
+
+def message_record(message):
+    """Returns what is kept of a message in an archive."""
+    return {
+        'id': message.id,
+        'created_at': message.created_at.isoformat(),
+        'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+        'author': {
+            'id': message.author.id,
+            'name': str(message.author),
+            'display_name': message.author.display_name,
+            'bot': message.author.bot
+        },
+        'type': message.type.name,
+        'content': message.content,
+        'pinned': message.pinned,
+        'attachments': [
+            {
+                'id': a.id,
+                'filename': a.filename,
+                'size': a.size,
+                'url': a.url,
+                'width': a.width,
+                'height': a.height
+            }
+            for a in message.attachments
+        ],
+        'embeds': [e.to_dict() for e in message.embeds],
+        'reactions': [{'emoji': str(r.emoji), 'count': r.count} for r in message.reactions]
+    }
+
+class Archive:
+    """Writes the history of text channels to gzipped JSON lines under ``root``.
+
+    Each channel goes to ``<root>/<guild id>/<group>/<channel>-<channel id>.jsonl.gz``,
+    oldest message first. History is streamed a page at a time, so memory use
+    does not grow with the channel. The id of the last message written is
+    kept in the store and a later archive of the channel appends from there;
+    a crash between writing a page and recording it can repeat that page, so
+    readers should skip ids they have already seen.
+    """
+    def __init__(self, root, store=None, limit=ARCHIVE_LIMIT):
+        self.root = root
+        self.store = store
+        self.limit = limit
+
+    def path(self, channel, category=None):
+        category = category or channel.category
+        group = f'{normalize_name(category.name)}-{category.id}' if category is not None else 'uncategorized'
+        return os.path.join(
+            self.root,
+            str(channel.guild.id),
+            group,
+            f'{normalize_name(channel.name)}-{channel.id}.jsonl.gz'
+        )
+
+    async def channel(self, channel, category=None):
+        """Appends the messages of ``channel`` not archived yet, returns how many were written.
+
+        ``category`` names the group directory when the channel's category is
+        already gone.
+        """
+        checkpoint = self.store.get_archive(channel.id) if self.store is not None else None
+        if checkpoint is not None:
+            # Keep appending to the same file even if the channel was renamed.
+            last_id, count, path = checkpoint
+        else:
+            last_id, count, path = None, 0, self.path(channel, category)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        after = discord.Object(id=last_id) if last_id is not None else None
+        written = 0
+        page = []
+        with gzip.open(path, 'ab') as f:
+            def write():
+                nonlocal written, count, page
+                f.write(b''.join(page))
+                # Makes the page readable even if the process dies before closing.
+                f.flush(zlib.Z_SYNC_FLUSH)
+                written += len(page)
+                count += len(page)
+                if self.store is not None:
+                    self.store.save_archive(channel.id, last_id, count, path)
+                page = []
+
+            async for message in channel.history(limit=None, after=after, oldest_first=True):
+                page.append(json.dumps(message_record(message), ensure_ascii=False).encode() + b'\n')
+                last_id = message.id
+                if len(page) >= 100:
+                    write()
+            if page:
+                write()
+        return written
+
+    async def channels(self, channels, category=None):
+        """Archives the text channels among ``channels``, ``self.limit`` at a time.
+
+        Returns ``(archived, failed)``: the number of messages written per
+        channel, and ``(channel, exception)`` for every channel that could not
+        be archived.
+        """
+        channels = [c for c in channels if isinstance(c, discord.TextChannel)]
+        results = await gather_limited(
+            *(self.channel(c, category) for c in channels),
+            limit=self.limit,
+            return_exceptions=True
+        )
+        archived = {}
+        failed = []
+        for c, result in zip(channels, results):
+            if isinstance(result, (discord.HTTPException, OSError)):
+                failed.append((c, result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                archived[c] = result
+        return archived, failed
+
+def get_archive(bot):
+    """Returns the archive of ``bot``, or ``None`` if archiving is turned off.
+
+    Archives are written to ``ARCHIVE_DIR``, ``archives`` by default. Setting
+    it to an empty value turns archiving off.
+    """
+    archive = getattr(bot, 'archive', ...)
+    if archive is ...:
+        root = os.getenv('ARCHIVE_DIR', 'archives')
+        archive = bot.archive = Archive(root, get_store(bot)) if root else None
+    return archive
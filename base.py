@@ -1,25 +1,146 @@
 # base.py
 from discord.ext import commands
 import discord
+import asyncio
 import traceback
 import sys
 import time
 
-from cogfactory import make_cog
+from cogfactory import get_group_cog
 from colors import colors, random_color
+from locks import SingleFlight
+from reconcile import get_reconciler, group_overwrites
+from registry import GroupEntry, get_registry, normalize_name
+from rest import gather_limited
+from rolequeue import get_role_queue
+from throttle import throttled
 
 class Base(commands.Cog, name='Base'):
     def __init__(self, bot):
         self.bot = bot
+        self.ready_guilds = set()
+        self.creating = SingleFlight()
+
+    def cog_unload(self):
+        get_reconciler(self.bot).stop()
 
     @commands.Cog.listener()
     async def on_ready(self):
+        """Sets up new guilds; guilds already set up before a reconnect are only reconciled.
+
+        Unavailable guilds have an empty cache, they are left to
+        :meth:`on_guild_available`.
+        """
         print(f'Logged in as {self.bot.user.name} - {self.bot.user.id}')
         if len(self.bot.guilds) == 0:
             raise commands.ExtensionFailed(message='Bot has no guilds.')
-        guild = self.bot.get_guild(self.bot.guilds[0].id)
-        for c in guild.categories:
-            self.bot.add_cog(make_cog(c.name)(self.bot))
+        registry = get_registry(self.bot)
+        available = [g for g in self.bot.guilds if not g.unavailable]
+        new = [g for g in available if g.id not in self.ready_guilds]
+        known = [g for g in available if g.id in self.ready_guilds]
+        stored = {}
+        if registry.store is not None and new:
+            for row in registry.store.load():
+                stored.setdefault(row[0], []).append(row)
+        await asyncio.gather(
+            *(self.setup_guild(g, stored.get(g.id)) for g in new),
+            *(self.resume_guild(g) for g in known)
+        )
+        get_reconciler(self.bot).start()
+
+    async def resume_guild(self, guild):
+        """Catches up with changes to a known guild made while the bot was disconnected."""
+        registry = get_registry(self.bot)
+        # Member updates may have been missed, so the role holders are reindexed.
+        registry.save_members(guild)
+        await get_reconciler(self.bot).run(guild)
+
+    async def setup_guild(self, guild, stored=None):
+        """Builds the groups of a single guild.
+
+        Uses the stored groups if there are any, otherwise the guild's
+        categories are scanned once and the result is stored. Either way the
+        holders of the group roles are indexed with one pass over the members.
+        """
+        registry = get_registry(self.bot)
+        registry.clear(guild.id)
+        if stored:
+            registry.load_guild(guild, stored)
+        else:
+            registry.index_guild(guild)
+        registry.save_members(guild)
+        self.ready_guilds.add(guild.id)
+        await get_reconciler(self.bot).run(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        store = get_registry(self.bot).store
+        await self.setup_guild(guild, store.load(guild.id) if store is not None else None)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        """Sets up or catches up with a guild that was unavailable at ready."""
+        # Before the bot is ready on_ready takes care of it.
+        if not self.bot.is_ready():
+            return
+        if guild.id in self.ready_guilds:
+            await self.resume_guild(guild)
+        else:
+            await self.on_guild_join(guild)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.roles == after.roles:
+            return
+        get_role_queue(self.bot).member_updated(after)
+        registry = get_registry(self.bot)
+        before_ids = {r.id for r in before.roles}
+        after_ids = {r.id for r in after.roles}
+        for role_id in after_ids - before_ids:
+            registry.member_added(role_id, after.id)
+        for role_id in before_ids - after_ids:
+            registry.member_removed(role_id, after.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        registry = get_registry(self.bot)
+        for r in member.roles:
+            registry.member_removed(r.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.ready_guilds.discard(guild.id)
+        get_registry(self.bot).clear(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        """Routes channel updates to the group that owns the channel."""
+        registry = get_registry(self.bot)
+        entry = registry.get(before.id)
+        if entry is not None:
+            await get_group_cog(self.bot).on_group_update(entry, before, after)
+            return
+        category_id = getattr(before, 'category_id', None)
+        if category_id is None or category_id == getattr(after, 'category_id', None):
+            return
+        entry = registry.get(category_id)
+        if entry is not None:
+            await get_group_cog(self.bot).on_channel_moved(entry, before, after)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        """Routes category deletions to the group that owns the category."""
+        entry = get_registry(self.bot).get(channel.id)
+        if entry is not None:
+            await get_group_cog(self.bot).on_group_delete(entry, channel)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        get_registry(self.bot).role_created(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        get_registry(self.bot).role_deleted(role)
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
@@ -107,63 +228,71 @@ class Base(commands.Cog, name='Base'):
         aliases=['make-group', 'new-group', 'make', 'new', 'create']
     )
     #async def create_group(self, ctx, group_name=''):
+    @throttled(cost=lambda self, ctx, users, **kwargs: 5 + len(users), concurrency=2)
     async def create_group(self, ctx, users: commands.Greedy[discord.Member], *, group_name=''):
         #await ctx.send(f'Executing {ctx.command} with args: {group_name}')
         if not group_name:
             group_name = hex(int(time.time())-(31536000*50)).replace('0x','').upper()
+        # Concurrent creations of one group share a single creation.
+        key = (ctx.guild.id, normalize_name(group_name))
+        joined = key in self.creating
+        entry = await self.creating.run(key, self._create_group, ctx, users, group_name)
+        if joined and users:
+            # The shared creation only added the users of the first caller.
+            # The role may not be cached yet, only its id is needed.
+            member_role = discord.Object(id=entry.member_role_id)
+            queue = get_role_queue(self.bot)
+            await asyncio.gather(*(queue.add_roles(u, member_role, reason=f'Added to group {entry.name}.') for u in users))
+
+    async def _create_group(self, ctx, users, group_name):
+        """Creates the group unless it exists, returns its entry."""
         guild = ctx.guild
-        existing_group = discord.utils.get(guild.categories, name=group_name)
-        if not existing_group:
-            member_role = await guild.create_role(
+        registry = get_registry(self.bot)
+        existing_group = registry.get_by_name(guild.id, group_name) or registry.get_by_cmd(guild.id, group_name)
+        if existing_group:
+            return existing_group
+        reason = f'Created group {group_name}.'
+        member_role, gm_role = await gather_limited(
+            guild.create_role(
                 name=f'{group_name} Member',
                 reason=f'Created group {group_name}'
-            )
-            gm_role = await guild.create_role(
+            ),
+            guild.create_role(
                 name=f'{group_name} GM',
                 color=discord.Color.dark_purple(),
                 reason=f'Created group {group_name}'
             )
-            category = await guild.create_category(
-                group_name,
-                reason=f'Created group {group_name}.',
-                overwrites={
-                    guild.default_role: discord.PermissionOverwrite(
-                        view_channel=False,
-                        send_messages=False,
-                        send_tts_messages=False,
-                        connect=False,
-                        speak=False
-                    ),
-                    member_role: discord.PermissionOverwrite(
-                        view_channel=True,
-                        send_messages=True,
-                        send_tts_messages=True,
-                        connect=True,
-                        speak=True
-                    ),
-                    gm_role: discord.PermissionOverwrite(
-                        #create_instant_invite=True,
-                        view_channel=True,
-                        send_messages=True,
-                        send_tts_messages=True,
-                        connect=True,
-                        speak=True,
-                        manage_channels=True,
-                        manage_permissions=True,
-                        move_members=True,
-                        mute_members=True,
-                        deafen_members=True,
-                        stream=True,
-                        priority_speaker=True
-                    ),
-                }
+        )
+        # Role grants only need the roles, so they run alongside the channels.
+        queue = get_role_queue(self.bot)
+        category, _ = await asyncio.gather(
+            self._create_group_channels(guild, group_name, member_role, gm_role),
+            asyncio.gather(
+                queue.add_roles(ctx.author, member_role, gm_role, reason=reason),
+                *(queue.add_roles(u, member_role, reason=reason) for u in users if u != ctx.author)
             )
-            await category.create_text_channel('general', reason=f'Created group {group_name}.')
-            await category.create_voice_channel('general', reason=f'Created group {group_name}.')
-            await ctx.author.add_roles(member_role, gm_role, reason=f'Created group {group_name}.')
-            for u in users:
-                await u.add_roles(member_role, reason=f'Created group {group_name}.')
-            self.bot.add_cog(make_cog(group_name)(self.bot))
+        )
+        entry = registry.add(GroupEntry(guild.id, category.id, member_role.id, gm_role.id, group_name))
+        # The member updates for these grants may have arrived before the
+        # group was registered, so the holders are recorded here. The creator
+        # goes first as the longest standing member.
+        registry.member_added(member_role.id, ctx.author.id)
+        registry.member_added(gm_role.id, ctx.author.id)
+        for u in users:
+            registry.member_added(member_role.id, u.id)
+        return entry
+
+    async def _create_group_channels(self, guild, group_name, member_role, gm_role):
+        category = await guild.create_category(
+            group_name,
+            reason=f'Created group {group_name}.',
+            overwrites=group_overwrites(guild, member_role, gm_role)
+        )
+        await gather_limited(
+            category.create_text_channel('general', reason=f'Created group {group_name}.'),
+            category.create_voice_channel('general', reason=f'Created group {group_name}.')
+        )
+        return category
 
 
 def setup(bot):
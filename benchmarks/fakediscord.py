@@ -0,0 +1,529 @@
+"""An in-memory stand-in for the Discord HTTP API and gateway.
+
+:class:`FakeDiscord` replaces the aiohttp session of a bot's HTTP client, so
+every request still goes through discord.py's own request code, including its
+rate limit handling. Requests are answered from in-memory guild state after
+``latency`` seconds, with ``X-Ratelimit-*`` headers from a per-route bucket and
+429 responses when a bucket is overdrawn. Mutations are echoed back as gateway
+events through the bot's connection state, the way Discord would.
+
+Nothing here opens a network connection.
+"""
+import asyncio
+import collections
+import copy
+import datetime
+import itertools
+import json
+import re
+import time
+
+import discord
+from discord.http import Route
+from multidict import CIMultiDict
+
+from reconcile import group_overwrites
+
+__all__ = ['FakeDiscord']
+
+TEXT, VOICE, CATEGORY = 0, 2, 4
+ADMINISTRATOR = 8
+
+class _Guild:
+    """Just enough of a guild for :func:`reconcile.group_overwrites`, keyed by ids."""
+    def __init__(self, guild_id):
+        self.default_role = guild_id
+
+def _now_iso():
+    return datetime.datetime.utcnow().isoformat()
+
+class FakeResponse:
+    def __init__(self, status, data, headers):
+        self.status = status
+        self.reason = 'Too Many Requests' if status == 429 else 'OK'
+        self._text = '' if data is None else json.dumps(data)
+        self.headers = CIMultiDict(headers)
+        if data is not None:
+            self.headers['content-type'] = 'application/json'
+
+    async def text(self, encoding='utf-8'):
+        return self._text
+
+    async def json(self):
+        return json.loads(self._text) if self._text else None
+
+class _RequestContext:
+    def __init__(self, discord, method, url, kwargs):
+        self.discord = discord
+        self.args = (method, url, kwargs)
+
+    async def __aenter__(self):
+        return await self.discord.handle(*self.args)
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeSession:
+    """Stands in for the ``aiohttp.ClientSession`` of ``discord.http.HTTPClient``."""
+    def __init__(self, discord):
+        self.discord = discord
+        self.closed = False
+
+    def request(self, method, url, **kwargs):
+        return _RequestContext(self.discord, method, url, kwargs)
+
+    async def close(self):
+        self.closed = True
+
+class _Bucket:
+    __slots__ = ('remaining', 'reset')
+
+    def __init__(self):
+        self.remaining = 0
+        self.reset = 0
+
+class FakeDiscord:
+    """In-memory Discord guilds served over a fake HTTP session.
+
+    ``latency`` is added to every request. Each route (method, path template
+    and major parameter) allows ``bucket_limit`` requests per ``bucket_per``
+    seconds.
+    """
+    def __init__(self, latency=0.0, bucket_limit=5, bucket_per=1.0, gateway_latency=None):
+        self.latency = latency
+        self.gateway_latency = latency if gateway_latency is None else gateway_latency
+        self.bucket_limit = bucket_limit
+        self.bucket_per = bucket_per
+        self.guilds = {}
+        self.users = {}
+        self.messages = collections.defaultdict(dict)
+        self.requests = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.state = None
+        self._buckets = collections.defaultdict(_Bucket)
+        self._counter = itertools.count()
+        self.bot_user = self.add_user('bot', bot=True)
+        self._routes = [
+            ('POST', r'/guilds/(\d+)/roles', self.create_role),
+            ('PATCH', r'/guilds/(\d+)/roles/(\d+)', self.edit_role),
+            ('DELETE', r'/guilds/(\d+)/roles/(\d+)', self.delete_role),
+            ('POST', r'/guilds/(\d+)/channels', self.create_channel),
+            ('PATCH', r'/channels/(\d+)', self.edit_channel),
+            ('DELETE', r'/channels/(\d+)', self.delete_channel),
+            ('PUT', r'/channels/(\d+)/permissions/(\d+)', self.edit_channel_permissions),
+            ('PATCH', r'/guilds/(\d+)/members/(\d+)', self.edit_member),
+            ('PUT', r'/guilds/(\d+)/members/(\d+)/roles/(\d+)', self.add_member_role),
+            ('DELETE', r'/guilds/(\d+)/members/(\d+)/roles/(\d+)', self.remove_member_role),
+            ('GET', r'/channels/(\d+)/messages', self.get_messages),
+            ('POST', r'/channels/(\d+)/messages', self.create_message),
+            ('POST', r'/channels/(\d+)/typing', self.no_content),
+            ('POST', r'/channels/(\d+)/messages/bulk_delete', self.bulk_delete_messages),
+            ('PATCH', r'/channels/(\d+)/messages/(\d+)', self.edit_message),
+            ('DELETE', r'/channels/(\d+)/messages/(\d+)', self.delete_message),
+            ('PUT', r'/channels/(\d+)/messages/(\d+)/reactions/([^/]+)/@me', self.no_content),
+            ('DELETE', r'/channels/(\d+)/messages/(\d+)/reactions(/[^/]+/[^/]+)?', self.no_content),
+        ]
+        self._routes = [(m, re.compile(p + '$'), p, h) for m, p, h in self._routes]
+
+    # Ids and payloads
+
+    def snowflake(self, when=None):
+        when = when or datetime.datetime.utcnow()
+        return discord.utils.time_snowflake(when) + next(self._counter) % (1 << 22)
+
+    def add_user(self, name, bot=False):
+        user = {
+            'id': str(self.snowflake()),
+            'username': name,
+            'discriminator': '0001',
+            'avatar': None,
+            'bot': bot
+        }
+        self.users[user['id']] = user
+        return user
+
+    def add_guild(self, name='Guild', members=0):
+        """Adds a guild with ``members`` plain members, an admin and the bot."""
+        guild_id = str(self.snowflake())
+        admin_role = self._role(guild_id, 'Admin', permissions=ADMINISTRATOR)
+        guild = {
+            'id': guild_id,
+            'name': name,
+            'owner_id': self.bot_user['id'],
+            'roles': {
+                guild_id: self._role(guild_id, '@everyone', id=guild_id, permissions=0x63584c0),
+                admin_role['id']: admin_role
+            },
+            'channels': {},
+            'members': {},
+            'admin_role_id': admin_role['id']
+        }
+        self.guilds[guild_id] = guild
+        self.add_member(guild_id, self.bot_user, roles=[admin_role['id']])
+        guild['admin'] = self.add_member(guild_id, self.add_user('admin'), roles=[admin_role['id']])
+        for i in range(members):
+            self.add_member(guild_id, self.add_user(f'member{i}'))
+        text = self._channel(guild_id, 'general', TEXT)
+        guild['channels'][text['id']] = text
+        guild['general_id'] = text['id']
+        return guild
+
+    def add_member(self, guild_id, user, roles=()):
+        member = {
+            'user': user,
+            'roles': list(roles),
+            'joined_at': _now_iso(),
+            'deaf': False,
+            'mute': False,
+            'nick': None
+        }
+        self.guilds[guild_id]['members'][user['id']] = member
+        return member
+
+    def add_group(self, guild_id, name, members=()):
+        """Adds a group's roles, category and channels directly, without any requests."""
+        guild = self.guilds[guild_id]
+        member_role = self._role(guild_id, f'{name} Member')
+        gm_role = self._role(guild_id, f'{name} GM')
+        for r in (member_role, gm_role):
+            guild['roles'][r['id']] = r
+        overwrites = []
+        for target, overwrite in group_overwrites(_Guild(guild_id), member_role['id'], gm_role['id']).items():
+            allow, deny = overwrite.pair()
+            overwrites.append({'id': target, 'type': 'role', 'allow': allow.value, 'deny': deny.value})
+        category = self._channel(guild_id, name, CATEGORY, overwrites=overwrites)
+        guild['channels'][category['id']] = category
+        for kind in (TEXT, VOICE):
+            c = self._channel(guild_id, 'general', kind, parent_id=category['id'], overwrites=overwrites)
+            guild['channels'][c['id']] = c
+        for i, user_id in enumerate(members):
+            roles = guild['members'][user_id]['roles']
+            roles.append(member_role['id'])
+            if i == 0:
+                roles.append(gm_role['id'])
+        return category
+
+    def _role(self, guild_id, name, id=None, permissions=0, color=0):
+        return {
+            'id': id or str(self.snowflake()),
+            'name': name,
+            'permissions': permissions,
+            'position': 1,
+            'color': color,
+            'hoist': False,
+            'managed': False,
+            'mentionable': False
+        }
+
+    def _channel(self, guild_id, name, kind, parent_id=None, overwrites=()):
+        channel = {
+            'id': str(self.snowflake()),
+            'guild_id': guild_id,
+            'name': name,
+            'type': kind,
+            'position': len(self.guilds[guild_id]['channels']),
+            'parent_id': parent_id,
+            'permission_overwrites': copy.deepcopy(list(overwrites)),
+            'nsfw': False,
+            'topic': None,
+            'bitrate': 64000,
+            'user_limit': 0,
+            'rate_limit_per_user': 0
+        }
+        return channel
+
+    def guild_payload(self, guild_id):
+        guild = self.guilds[guild_id]
+        return {
+            'id': guild_id,
+            'name': guild['name'],
+            'owner_id': guild['owner_id'],
+            'roles': copy.deepcopy(list(guild['roles'].values())),
+            'channels': copy.deepcopy(list(guild['channels'].values())),
+            'members': copy.deepcopy(list(guild['members'].values())),
+            'member_count': len(guild['members']),
+            'large': False,
+            'emojis': [],
+            'features': [],
+            'region': 'us-west',
+            'verification_level': 0,
+            'default_message_notifications': 0,
+            'explicit_content_filter': 0,
+            'afk_timeout': 300,
+            'mfa_level': 0
+        }
+
+    def message_payload(self, channel_id, user, content, when=None, **fields):
+        channel = self._find_channel(channel_id)
+        message = {
+            'id': str(self.snowflake(when)),
+            'channel_id': channel_id,
+            'guild_id': channel['guild_id'],
+            'author': user,
+            'content': content,
+            'timestamp': (when or datetime.datetime.utcnow()).isoformat(),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0
+        }
+        message.update(fields)
+        return message
+
+    # Wiring to a bot
+
+    def attach(self, bot):
+        """Points ``bot`` at this stand-in and fills its cache with every guild."""
+        state = bot._connection
+        self.state = state
+        bot.http._HTTPClient__session = FakeSession(self)
+        bot.http.token = 'fake'
+        state.user = discord.ClientUser(state=state, data=self.bot_user)
+        for guild_id in self.guilds:
+            state._add_guild_from_data(self.guild_payload(guild_id))
+        return bot
+
+    def gateway(self, event, data):
+        """Delivers a gateway event to the attached bot after the gateway latency."""
+        if self.state is None:
+            return
+        # discord.py consumes parts of the payloads it parses.
+        parser = getattr(self.state, 'parse_' + event)
+        asyncio.get_event_loop().call_later(self.gateway_latency, parser, copy.deepcopy(data))
+
+    def message(self, channel_id, user, content, **fields):
+        """Stores a message and returns it as a :class:`discord.Message` without dispatching it."""
+        data = self.message_payload(channel_id, user, content, **fields)
+        self.messages[channel_id][data['id']] = data
+        channel = self.state.get_channel(int(channel_id))
+        return discord.Message(state=self.state, channel=channel, data=data)
+
+    def receive(self, channel_id, user, content, **fields):
+        """Stores a message and dispatches it to the bot as ``MESSAGE_CREATE`` right away."""
+        data = self.message_payload(channel_id, user, content, **fields)
+        self.messages[channel_id][data['id']] = data
+        self.state.parse_message_create(copy.deepcopy(data))
+        return data
+
+    def rename_channel(self, channel_id, name):
+        """Renames a channel as if a user did it in the client."""
+        channel = self._find_channel(channel_id)
+        channel['name'] = name
+        self.state.parse_channel_update(copy.deepcopy(channel))
+        return channel
+
+    # HTTP
+
+    async def handle(self, method, url, kwargs):
+        path = url[len(Route.BASE):]
+        for m, pattern, template, handler in self._routes:
+            match = pattern.match(path)
+            if m == method and match:
+                break
+        else:
+            return FakeResponse(404, {'message': f'Unknown route {method} {path}', 'code': 0}, {})
+
+        route = f'{method} {template}'
+        self.requests[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        bucket = self._buckets[(route, match.group(1))]
+        now = time.time()
+        if now >= bucket.reset:
+            bucket.remaining = self.bucket_limit
+            bucket.reset = now + self.bucket_per
+        if bucket.remaining <= 0:
+            self.rate_limited[route] += 1
+            retry_after = bucket.reset - now
+            return FakeResponse(
+                429,
+                {'message': 'You are being rate limited.', 'retry_after': retry_after * 1000, 'global': False},
+                {'Via': 'fake', 'Retry-After': str(int(retry_after * 1000))}
+            )
+        bucket.remaining -= 1
+        headers = {
+            'X-Ratelimit-Limit': str(self.bucket_limit),
+            'X-Ratelimit-Remaining': str(bucket.remaining),
+            'X-Ratelimit-Reset': str(bucket.reset),
+            'X-Ratelimit-Reset-After': str(max(bucket.reset - now, 0))
+        }
+
+        body = kwargs.get('data')
+        body = json.loads(body) if isinstance(body, str) and body else {}
+        status, data = handler(*match.groups(), body=body, params=kwargs.get('params') or {})
+        return FakeResponse(status, data, headers)
+
+    def _find_channel(self, channel_id):
+        for guild in self.guilds.values():
+            channel = guild['channels'].get(channel_id)
+            if channel is not None:
+                return channel
+        return None
+
+    def no_content(self, *args, body, params):
+        return 204, None
+
+    def create_role(self, guild_id, *, body, params):
+        role = self._role(
+            guild_id,
+            body.get('name', 'new role'),
+            permissions=int(body.get('permissions', 0)),
+            color=body.get('color', 0)
+        )
+        self.guilds[guild_id]['roles'][role['id']] = role
+        self.gateway('guild_role_create', {'guild_id': guild_id, 'role': role})
+        return 200, role
+
+    def edit_role(self, guild_id, role_id, *, body, params):
+        role = self.guilds[guild_id]['roles'].get(role_id)
+        if role is None:
+            return 404, {'message': 'Unknown Role', 'code': 10011}
+        role.update({k: v for k, v in body.items() if k in role})
+        self.gateway('guild_role_update', {'guild_id': guild_id, 'role': role})
+        return 200, role
+
+    def delete_role(self, guild_id, role_id, *, body, params):
+        guild = self.guilds[guild_id]
+        if guild['roles'].pop(role_id, None) is None:
+            return 404, {'message': 'Unknown Role', 'code': 10011}
+        for member in guild['members'].values():
+            if role_id in member['roles']:
+                member['roles'].remove(role_id)
+        self.gateway('guild_role_delete', {'guild_id': guild_id, 'role_id': role_id})
+        return 204, None
+
+    def create_channel(self, guild_id, *, body, params):
+        channel = self._channel(
+            guild_id,
+            body.get('name', 'channel'),
+            body.get('type', TEXT),
+            parent_id=body.get('parent_id'),
+            overwrites=body.get('permission_overwrites', ())
+        )
+        self.guilds[guild_id]['channels'][channel['id']] = channel
+        self.gateway('channel_create', channel)
+        return 200, channel
+
+    def edit_channel(self, channel_id, *, body, params):
+        channel = self._find_channel(channel_id)
+        if channel is None:
+            return 404, {'message': 'Unknown Channel', 'code': 10003}
+        channel.update({k: v for k, v in body.items() if k in channel})
+        self.gateway('channel_update', channel)
+        return 200, channel
+
+    def edit_channel_permissions(self, channel_id, target_id, *, body, params):
+        channel = self._find_channel(channel_id)
+        if channel is None:
+            return 404, {'message': 'Unknown Channel', 'code': 10003}
+        overwrites = [o for o in channel['permission_overwrites'] if o['id'] != target_id]
+        overwrites.append({
+            'id': target_id,
+            'type': body['type'],
+            'allow': body['allow'],
+            'deny': body['deny']
+        })
+        channel['permission_overwrites'] = overwrites
+        self.gateway('channel_update', channel)
+        return 204, None
+
+    def delete_channel(self, channel_id, *, body, params):
+        channel = self._find_channel(channel_id)
+        if channel is None:
+            return 404, {'message': 'Unknown Channel', 'code': 10003}
+        channels = self.guilds[channel['guild_id']]['channels']
+        del channels[channel_id]
+        self.messages.pop(channel_id, None)
+        self.gateway('channel_delete', channel)
+        # Like Discord, the children of a deleted category are moved out of it.
+        for child in channels.values():
+            if child['parent_id'] == channel_id:
+                child['parent_id'] = None
+                self.gateway('channel_update', child)
+        return 200, channel
+
+    def _member_updated(self, guild_id, member):
+        self.gateway('guild_member_update', {
+            'guild_id': guild_id,
+            'user': member['user'],
+            'roles': list(member['roles']),
+            'nick': member['nick']
+        })
+
+    def edit_member(self, guild_id, user_id, *, body, params):
+        member = self.guilds[guild_id]['members'].get(user_id)
+        if member is None:
+            return 404, {'message': 'Unknown Member', 'code': 10007}
+        if 'roles' in body:
+            member['roles'] = [str(r) for r in body['roles']]
+        self._member_updated(guild_id, member)
+        return 204, None
+
+    def add_member_role(self, guild_id, user_id, role_id, *, body, params):
+        member = self.guilds[guild_id]['members'][user_id]
+        if role_id not in member['roles']:
+            member['roles'].append(role_id)
+        self._member_updated(guild_id, member)
+        return 204, None
+
+    def remove_member_role(self, guild_id, user_id, role_id, *, body, params):
+        member = self.guilds[guild_id]['members'][user_id]
+        if role_id in member['roles']:
+            member['roles'].remove(role_id)
+        self._member_updated(guild_id, member)
+        return 204, None
+
+    def get_messages(self, channel_id, *, body, params):
+        messages = sorted(self.messages.get(channel_id, {}).values(), key=lambda m: int(m['id']), reverse=True)
+        if 'before' in params:
+            messages = [m for m in messages if int(m['id']) < int(params['before'])]
+        if 'after' in params:
+            messages = [m for m in messages if int(m['id']) > int(params['after'])]
+            messages.reverse()
+            messages = messages[:int(params.get('limit', 50))]
+            messages.reverse()
+        return 200, messages[:int(params.get('limit', 50))]
+
+    def create_message(self, channel_id, *, body, params):
+        data = self.message_payload(
+            channel_id,
+            self.bot_user,
+            body.get('content') or '',
+            embeds=[body['embed']] if body.get('embed') else []
+        )
+        self.messages[channel_id][data['id']] = data
+        self.gateway('message_create', data)
+        return 200, data
+
+    def edit_message(self, channel_id, message_id, *, body, params):
+        data = self.messages.get(channel_id, {}).get(message_id)
+        if data is None:
+            return 404, {'message': 'Unknown Message', 'code': 10008}
+        if 'content' in body:
+            data['content'] = body['content'] or ''
+        if 'embed' in body:
+            data['embeds'] = [body['embed']] if body['embed'] else []
+        data['edited_timestamp'] = _now_iso()
+        return 200, data
+
+    def delete_message(self, channel_id, message_id, *, body, params):
+        if self.messages.get(channel_id, {}).pop(message_id, None) is None:
+            return 404, {'message': 'Unknown Message', 'code': 10008}
+        self.gateway('message_delete', {'id': message_id, 'channel_id': channel_id})
+        return 204, None
+
+    def bulk_delete_messages(self, channel_id, *, body, params):
+        ids = [str(i) for i in body.get('messages', [])]
+        limit = discord.utils.time_snowflake(datetime.datetime.utcnow() - datetime.timedelta(days=14))
+        if not 2 <= len(ids) <= 100 or any(int(i) < limit for i in ids):
+            return 400, {'message': 'You can only bulk delete messages that are under 14 days old.', 'code': 50034}
+        for i in ids:
+            self.messages.get(channel_id, {}).pop(i, None)
+        self.gateway('message_delete_bulk', {'ids': ids, 'channel_id': channel_id})
+        return 204, None
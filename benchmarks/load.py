@@ -0,0 +1,201 @@
+"""Replays synthetic command traffic against the bot to find where it saturates.
+
+Run from the repository root:
+
+    python -m benchmarks.load --rate 50 100 200 --duration 10
+
+Messages are delivered to the bot as ``MESSAGE_CREATE`` gateway events from
+:mod:`benchmarks.fakediscord` at a fixed rate, open loop, so a slow bot builds
+up a backlog instead of slowing the traffic down. The traffic is a weighted mix
+of ``!help``, ``!<group> add``, ``!create-group`` and category renames, set with
+``--mix``.
+
+For every rate the report shows the commands completed per second, the p50 and
+p99 latency from delivery to completion and how late the event loop woke up a
+timer. The bot is saturated once throughput stops following the offered rate
+and latency keeps growing with the run.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from benchmarks.suite import Harness
+from registry import get_registry
+
+DEFAULT_MIX = 'help=2,add=5,create=1,rename=1'
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    unknown = set(weights) - set(Traffic.KINDS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f'Unknown traffic: {", ".join(sorted(unknown))}')
+    return weights
+
+class LagMonitor:
+    """Measures how late the event loop runs a timer scheduled every ``interval``."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+class Traffic:
+    KINDS = ('help', 'add', 'create', 'rename')
+
+    def __init__(self, harness, mix, seed=0):
+        self.harness = harness
+        self.random = random.Random(seed)
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.sent = {}
+        self.latencies = []
+        self.errors = []
+        self.renames = 0
+        self._created = 0
+        bot = harness.bot
+        bot.add_listener(self.on_command_completion)
+        bot.add_listener(self.on_command_error)
+
+    def _done(self, ctx):
+        start = self.sent.pop(ctx.message.id, None)
+        if start is not None:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def on_command_completion(self, ctx):
+        self._done(ctx)
+
+    async def on_command_error(self, ctx, error):
+        self._done(ctx)
+        self.errors.append(error)
+
+    def _group(self):
+        entries = get_registry(self.harness.bot).entries(self.harness.guild.id)
+        return self.random.choice(entries) if entries else None
+
+    def send(self, content):
+        h = self.harness
+        start = time.perf_counter()
+        data = h.fake.receive(h.channel_id, h.admin, content)
+        self.sent[int(data['id'])] = start
+
+    def step(self):
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        if kind == 'help':
+            self.send('!help')
+        elif kind == 'create':
+            self._created += 1
+            self.send(f'!create-group Load Group {self._created}')
+        else:
+            entry = self._group()
+            if entry is None:
+                return
+            if kind == 'add':
+                self.send(f'!{entry.cmd} add <@{self.harness.member_id(self.random.randrange(1 << 16))}>')
+            else:
+                self.renames += 1
+                self.harness.fake.rename_channel(str(entry.group_id), f'{entry.name} {self.renames}')
+
+async def run(rate, args):
+    harness = Harness(args.groups, args.members, args.latency, args.bucket_limit, args.window, args.command_rate)
+    await harness.on_ready()
+    traffic = Traffic(harness, args.mix, args.seed)
+    lag = LagMonitor()
+    lag.start()
+
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    sent = 0
+    while loop.time() - start < args.duration:
+        # Catch up on the arrivals that are due, then sleep until the next one.
+        due = int((loop.time() - start) * rate)
+        while sent < due:
+            traffic.step()
+            sent += 1
+        await asyncio.sleep(1 / rate)
+    elapsed = loop.time() - start
+
+    # Give the backlog a bounded time to drain; anything left counts as dropped.
+    deadline = loop.time() + args.drain
+    while traffic.sent and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    lag.stop()
+    pending = len(traffic.sent)
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    await asyncio.sleep(0)
+
+    completed = len(traffic.latencies)
+    return {
+        'rate': rate,
+        'sent': sent - traffic.renames,
+        'completed': completed,
+        'throughput': completed / (loop.time() - start),
+        'elapsed': elapsed,
+        'p50': percentile(traffic.latencies, 50),
+        'p99': percentile(traffic.latencies, 99),
+        'lag_p50': percentile(lag.lags, 50),
+        'lag_p99': percentile(lag.lags, 99),
+        'lag_max': max(lag.lags, default=float('nan')),
+        'errors': len(traffic.errors),
+        'pending': pending,
+        'renames': traffic.renames,
+        'requests': sum(harness.fake.requests.values()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, nargs='+', default=[25, 50, 100, 200], help='Messages per second.')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of traffic per rate.')
+    parser.add_argument('--drain', type=float, default=10.0, help='Seconds to wait for the backlog.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--members', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every request.')
+    parser.add_argument('--bucket-limit', type=int, default=50, help='Requests allowed per route per second.')
+    parser.add_argument('--window', type=float, default=0.5, help='Role queue window in seconds.')
+    parser.add_argument('--command-rate', type=float, default=None, help='Per-guild command budget in tokens a second, unlimited by default.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    header = f'{"rate":>7} {"sent":>6} {"done":>6} {"cmd/s":>7} {"p50":>9} {"p99":>9} {"lag p50":>9} {"lag p99":>9} {"lag max":>9} {"errors":>6} {"left":>5}'
+    rows = []
+    for rate in args.rate:
+        r = loop.run_until_complete(run(rate, args))
+        rows.append(
+            f'{r["rate"]:>7.0f} {r["sent"]:>6} {r["completed"]:>6} {r["throughput"]:>7.1f}'
+            f' {r["p50"] * 1000:>7.1f}ms {r["p99"] * 1000:>7.1f}ms'
+            f' {r["lag_p50"] * 1000:>7.1f}ms {r["lag_p99"] * 1000:>7.1f}ms {r["lag_max"] * 1000:>7.1f}ms'
+            f' {r["errors"]:>6} {r["pending"]:>5}'
+        )
+        print(f'{rate:.0f}/s: {r["requests"]} requests, {r["renames"]} renames', file=sys.stderr)
+    print(header)
+    print('\n'.join(rows))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
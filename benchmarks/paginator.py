@@ -0,0 +1,57 @@
+"""Times EmbedPaginator on a synthetic bot help with many commands and groups.
+
+Run from the repository root:
+
+    python -m benchmarks.paginator --commands 1000
+
+The help is paginated at ``--commands`` and four times that. Pagination is
+linear, so the second run should take about four times as long; a ratio above
+``--max-ratio`` exits with status 1.
+"""
+import argparse
+import sys
+import timeit
+
+from help import EmbedPaginator
+
+def paginate(commands):
+    p = EmbedPaginator()
+    p.set_title('Help')
+    p.set_footer('Requested by benchmark')
+    p.set_prefix('```')
+    p.set_suffix('```')
+    for c in range(max(1, commands // 10)):
+        p.add_name(f'Category {c}')
+        for i in range(10):
+            p.add_line(f'  command-{c}-{i:<12} Does something useful for the group.')
+    p.clear_prefix()
+    p.clear_suffix()
+    p.add_name('Groups')
+    for i in range(commands):
+        p.add_line(f'**Group {i}**: `group-{i}`')
+    return p.raw_pages
+
+def bench(commands, repeat):
+    return min(timeit.repeat(lambda: paginate(commands), number=1, repeat=repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commands', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-ratio', type=float, default=6.0)
+    args = parser.parse_args()
+
+    small = bench(args.commands, args.repeat)
+    large = bench(args.commands * 4, args.repeat)
+    pages = len(paginate(args.commands))
+    ratio = large / small
+    print(f'{args.commands} commands: {small * 1000:.2f} ms ({pages} pages)')
+    print(f'{args.commands * 4} commands: {large * 1000:.2f} ms')
+    print(f'scaling ratio: {ratio:.2f} (linear is 4)')
+    if ratio > args.max_ratio:
+        print(f'Scaling ratio above {args.max_ratio}, pagination is no longer linear.', file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
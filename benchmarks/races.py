@@ -0,0 +1,165 @@
+"""Replays races the bot has had against :mod:`benchmarks.fakediscord`.
+
+Run from the repository root:
+
+    python -m benchmarks.races
+
+Every scenario attaches a fresh bot to a small fake guild, provokes one race
+that used to leave the guild or the bot in the wrong state and checks the
+outcome. Gateway events are echoed with a delay, as Discord does, so the
+bot's cache lags behind its own requests. Exits with status 1 if any check
+fails.
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import sys
+import time
+
+from archive import get_archive
+from benchmarks.suite import Harness
+from registry import get_registry
+from rolequeue import get_role_queue
+
+SCENARIOS = []
+
+def scenario(func):
+    SCENARIOS.append(func)
+    return func
+
+class CheckFailed(Exception):
+    pass
+
+def expect(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+class RaceHarness(Harness):
+    def __init__(self, groups, members, latency, gateway_latency):
+        super().__init__(groups, members, latency, bucket_limit=50, window=0.0)
+        self.fake.gateway_latency = gateway_latency
+
+    def entry(self, name):
+        return get_registry(self.bot).get_by_name(self.guild.id, name)
+
+    def outsider(self, role_ids):
+        """Returns a member who has none of ``role_ids``."""
+        return next(
+            m.id for m in self.guild.members
+            if not m.bot and m.id != int(self.admin['id']) and not role_ids & {r.id for r in m.roles}
+        )
+
+    def roles_of(self, user_id):
+        """The role ids the fake, not the bot's cache, says ``user_id`` has."""
+        return {int(r) for r in self.fake.guilds[self.guild_id]['members'][str(user_id)]['roles']}
+
+@scenario
+async def role_edits_in_a_row(harness):
+    """Two groups add the same member before the first edit's update arrives."""
+    get_role_queue(harness.bot).window = harness.fake.gateway_latency / 2
+    roles = {harness.entry(name).member_role_id for name in ('Group 1', 'Group 2')}
+    user_id = harness.outsider(roles)
+    for name in ('group-1', 'group-2'):
+        await harness.command(f'!{name} add <@{user_id}>')
+    await harness.settle()
+    expect(roles <= harness.roles_of(user_id), 'the second edit took back the first')
+
+@scenario
+async def create_group_holders(harness):
+    """The member updates of a new group's grants arrive before it is registered."""
+    harness.fake.gateway_latency = 0.0
+    registry = get_registry(harness.bot)
+    creator = int(harness.admin['id'])
+    users = [harness.member_id(0), harness.member_id(1)]
+    await harness.command('!create-group ' + ' '.join(f'<@{u}>' for u in users) + ' Probe')
+    await harness.settle()
+    entry = harness.entry('Probe')
+    expect(entry is not None, 'the group was not created')
+    for role_id, expected in ((entry.member_role_id, [creator, *users]), (entry.gm_role_id, [creator])):
+        expect(registry.members.holders(role_id) == expected, f'indexed {registry.members.holders(role_id)}, not {expected}')
+        expect(registry.store.members(role_id) == expected, f'stored {registry.store.members(role_id)}, not {expected}')
+
+@scenario
+async def category_deleted_by_hand(harness):
+    """A user deletes a group's category and Discord moves its channels out while they are archived."""
+    entry = harness.entry('Group 1')
+    category = harness.guild.get_channel(entry.group_id)
+    text = category.text_channels[0]
+    path = get_archive(harness.bot).path(text, category)
+    channel_ids = [str(c.id) for c in category.channels]
+    for i in range(250):
+        harness.fake.message(str(text.id), harness.admin, f'message {i}')
+    harness.fake.delete_channel(str(category.id), body={}, params={})
+    registry = get_registry(harness.bot)
+    for _ in range(100):
+        if registry.get(entry.group_id) is None:
+            break
+        await asyncio.sleep(0.1)
+    expect(registry.get(entry.group_id) is None, 'the group was not forgotten')
+    await harness.settle()
+    archived = 0
+    if os.path.exists(path):
+        with gzip.open(path, 'rt') as f:
+            archived = sum(1 for _ in f)
+    expect(archived == 250, f'archived {archived} of 250 messages')
+    left = [i for i in channel_ids if i in harness.fake.guilds[harness.guild_id]['channels']]
+    expect(not left, f'{len(left)} channels left behind')
+
+@scenario
+async def create_group_twice(harness):
+    """Two users create the same group with different members at once."""
+    a, b = harness.member_id(0), harness.member_id(1)
+    await asyncio.gather(
+        harness.command(f'!create-group <@{a}> Probe'),
+        harness.command(f'!create-group <@{b}> Probe')
+    )
+    await harness.settle()
+    guild = harness.fake.guilds[harness.guild_id]
+    categories = [c for c in guild['channels'].values() if c['name'] == 'Probe']
+    roles = [r for r in guild['roles'].values() if r['name'] in ('Probe Member', 'Probe GM')]
+    expect(len(categories) == 1, f'{len(categories)} categories created')
+    expect(len(roles) == 2, f'{len(roles)} roles created')
+    member_role_id = harness.entry('Probe').member_role_id
+    for user_id in (a, b):
+        expect(member_role_id in harness.roles_of(user_id), f'<@{user_id}> did not get the Member role')
+
+async def run(func, args):
+    harness = RaceHarness(args.groups, args.members, args.latency, args.gateway_latency)
+    try:
+        await harness.on_ready()
+        await harness.settle()
+        await func(harness)
+        expect(not harness.errors, f'commands failed: {harness.errors!r}')
+    finally:
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', help='Scenarios to run, all by default.')
+    parser.add_argument('--groups', type=int, default=5)
+    parser.add_argument('--members', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds added to every request.')
+    parser.add_argument('--gateway-latency', type=float, default=0.5, help='Seconds before a change is echoed back.')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    status = 0
+    for func in SCENARIOS:
+        if args.scenarios and func.__name__ not in args.scenarios:
+            continue
+        start = time.perf_counter()
+        try:
+            loop.run_until_complete(run(func, args))
+        except CheckFailed as e:
+            result = f'FAIL {e}'
+            status = 1
+        else:
+            result = 'ok'
+        print(f'{func.__name__:<30}{time.perf_counter() - start:>6.1f}s  {result}')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
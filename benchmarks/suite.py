@@ -0,0 +1,178 @@
+"""Times the bot's main code paths against :mod:`benchmarks.fakediscord`.
+
+Run from the repository root:
+
+    python -m benchmarks.suite --groups 10 100 1000
+
+For every group count a fresh bot is attached to a fake guild holding that
+many groups, then each scenario is timed end to end, including the requests it
+makes to the fake API. Nothing touches the network, the group store lives in
+memory and archives are written to a temporary directory.
+
+The role queue window is set to ``--window`` (0 by default) and the per-guild
+command budget is lifted, so the timings show the work done rather than the
+coalescing delay or throttling. When the largest group count
+takes more than ``--max-ratio`` times as long as the smallest for a scenario
+that should not depend on the number of groups, the suite exits with status 1.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('GROUP_DB', ':memory:')
+# Removed when the interpreter exits.
+_archives = tempfile.TemporaryDirectory(prefix='groupbot-archives-')
+os.environ.setdefault('ARCHIVE_DIR', _archives.name)
+
+from benchmarks.fakediscord import FakeDiscord
+from help import get_help_cache
+from registry import get_registry
+from rolequeue import get_role_queue
+from throttle import get_limiter
+
+# Scenarios whose cost should not grow with the number of groups.
+CONSTANT = ('create-group', 'group add', 'group leave', 'help cached')
+
+class Harness:
+    def __init__(self, groups, members, latency, bucket_limit, window, command_rate=None):
+        from bot import make_bot
+        self.fake = FakeDiscord(latency=latency, bucket_limit=bucket_limit)
+        guild = self.fake.add_guild(members=members)
+        self.guild_id = guild['id']
+        self.admin = guild['admin']['user']
+        self.channel_id = guild['general_id']
+        member_ids = [i for i in guild['members'] if i != self.fake.bot_user['id']]
+        for i in range(groups):
+            # The admin is the GM of the first group, everyone else is spread out.
+            members = [self.admin['id']] if i == 0 else member_ids[i % len(member_ids):][:3]
+            self.fake.add_group(self.guild_id, f'Group {i}', members)
+        self.bot = make_bot()
+        self.fake.attach(self.bot)
+        get_role_queue(self.bot).window = window
+        limiter = get_limiter(self.bot)
+        if command_rate is None:
+            limiter.rate = limiter.burst = 1e9
+        else:
+            limiter.rate = command_rate
+        self.errors = []
+        async def on_command_error(ctx, error):
+            self.errors.append((ctx.message.content, error))
+        self.bot.add_listener(on_command_error)
+
+    @property
+    def guild(self):
+        return self.bot.get_guild(int(self.guild_id))
+
+    def member_id(self, n):
+        ids = [m.id for m in self.guild.members if not m.bot and m.id != int(self.admin['id'])]
+        return ids[n % len(ids)]
+
+    async def settle(self):
+        """Waits for echoed gateway events and spawned tasks to finish."""
+        await asyncio.sleep(self.fake.gateway_latency + 0.01)
+        await get_role_queue(self.bot).flush()
+        await asyncio.sleep(0)
+
+    async def command(self, content):
+        message = self.fake.message(self.channel_id, self.admin, content)
+        await self.bot.process_commands(message)
+
+    async def on_ready(self):
+        await self.bot.get_cog('Base').on_ready()
+
+async def time_once(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+async def run_scenarios(harness, repeat):
+    results = {}
+    async def measure(name, make, settle=True, setup=None):
+        times = []
+        for i in range(repeat):
+            if setup is not None:
+                await setup(i)
+                await harness.settle()
+            times.append(await time_once(make(i)))
+            if settle:
+                await harness.settle()
+        results[name] = statistics.median(times)
+
+    # The first on_ready sets the guild up, later ones are reconnects that only reconcile it.
+    await measure('on_ready cold', lambda i: harness.on_ready(), settle=False)
+    await measure('on_ready warm', lambda i: harness.on_ready())
+    await measure('create-group', lambda i: harness.command(f'!create-group New Group {i}'))
+    await measure('group add', lambda i: harness.command(f'!group-0 add <@{harness.member_id(i)}>'))
+    async def rejoin(i):
+        await harness.command(f'!group-0 gm add <@{harness.admin["id"]}>')
+    await measure('group leave', lambda i: harness.command('!group-0 leave'), setup=rejoin)
+
+    async def help_cold(i):
+        get_help_cache(harness.bot).clear()
+        await harness.command('!help')
+    await measure('help cold', help_cold)
+    await measure('help cached', lambda i: harness.command('!help'))
+
+    # Tearing down every group can only be measured once per guild.
+    results['clear-groups'] = await time_once(harness.command('!clear-groups'))
+    await harness.settle()
+    return results
+
+async def run(groups, args):
+    harness = Harness(groups, args.members, args.latency, args.bucket_limit, args.window)
+    try:
+        results = await run_scenarios(harness, args.repeat)
+    finally:
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+    left = len(get_registry(harness.bot))
+    if left:
+        harness.errors.append(('!clear-groups', f'{left} groups left after teardown'))
+    return results, harness
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--groups', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--members', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--bucket-limit', type=int, default=50, help='Requests allowed per route per second.')
+    parser.add_argument('--window', type=float, default=0.0, help='Role queue window in seconds.')
+    parser.add_argument('--max-ratio', type=float, default=5.0)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    table = {}
+    status = 0
+    for groups in args.groups:
+        results, harness = loop.run_until_complete(run(groups, args))
+        table[groups] = results
+        requests = sum(harness.fake.requests.values())
+        limited = sum(harness.fake.rate_limited.values())
+        print(f'{groups} groups: {requests} requests, {limited} rate limited', file=sys.stderr)
+        for content, error in harness.errors:
+            print(f'  {content}: {error!r}', file=sys.stderr)
+            status = 1
+
+    names = list(table[args.groups[0]])
+    width = max(len(n) for n in names)
+    print(f'{"scenario":<{width}}' + ''.join(f'{g:>12}' for g in args.groups))
+    for name in names:
+        print(f'{name:<{width}}' + ''.join(f'{table[g][name] * 1000:>10.1f}ms' for g in args.groups))
+
+    small, large = min(args.groups), max(args.groups)
+    if small != large:
+        for name in CONSTANT:
+            ratio = table[large][name] / max(table[small][name], 1e-6)
+            if ratio > args.max_ratio:
+                print(f'{name} takes {ratio:.1f}x as long with {large} groups as with {small}.', file=sys.stderr)
+                status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
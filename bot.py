@@ -1,4 +1,5 @@
 # bot.py
+import argparse
 import os
 import traceback
 import sys
@@ -8,15 +9,68 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 
-from cogfactory import GroupCog, make_cog
+from cogfactory import GroupCog
 from colors import random_color
+from groupbot import AutoShardedGroupBot, GroupBot
 from help import MyHelpCommand
+from loopmonitor import get_loop_monitor
+from metrics import get_metrics
+from tracing import get_tracer
+from supervisor import Supervisor
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 
-bot = commands.Bot(command_prefix='!', help_command=MyHelpCommand())
-bot.load_extension('base')
-bot.load_extension('util')
+def make_bot(shard_ids=None, shard_count=None):
+    if shard_count is None:
+        bot = GroupBot(command_prefix='!', help_command=MyHelpCommand())
+    else:
+        bot = AutoShardedGroupBot(
+            command_prefix='!',
+            help_command=MyHelpCommand(),
+            shard_ids=shard_ids,
+            shard_count=shard_count
+        )
+    bot.load_extension('base')
+    bot.load_extension('util')
+    port = os.getenv('METRICS_PORT')
+    path = os.getenv('METRICS_FILE')
+    traces = os.getenv('TRACE_FILE')
+    if shard_ids:
+        # Workers of one supervisor each need their own port and files.
+        port = port and int(port) + shard_ids[0]
+        path = path and f'{path}.{shard_ids[0]}'
+        traces = traces and f'{traces}.{shard_ids[0]}'
+    get_metrics(bot).configure(
+        port=int(port) if port else None,
+        path=path or None,
+        interval=float(os.getenv('METRICS_INTERVAL', '15'))
+    )
+    get_tracer(bot).configure(traces or None, float(os.getenv('TRACE_SAMPLE', '1')))
+    get_loop_monitor(bot).threshold = float(os.getenv('LOOP_LAG_THRESHOLD', '0.1'))
+    return bot
 
-bot.run(TOKEN)
+def parse_args():
+    parser = argparse.ArgumentParser(description='Runs the TTRPG bot.')
+    parser.add_argument(
+        '--processes', type=int, default=int(os.getenv('BOT_PROCESSES', '1')),
+        help='Number of worker processes to supervise.'
+    )
+    parser.add_argument(
+        '--shard-count', type=int, default=os.getenv('SHARD_COUNT'),
+        help='Total number of shards across all processes.'
+    )
+    parser.add_argument(
+        '--shard-ids', default=None,
+        help='Comma separated shard ids owned by this process.'
+    )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    shard_count = int(args.shard_count) if args.shard_count else None
+    if args.shard_ids is None and args.processes > 1:
+        Supervisor(args.processes, shard_count).run()
+    else:
+        shard_ids = [int(i) for i in args.shard_ids.split(',')] if args.shard_ids else None
+        make_bot(shard_ids, shard_count).run(TOKEN)
@@ -1,12 +1,21 @@
+import asyncio
+import collections
+import functools
 import os
 import traceback
 import sys
-import re
 import time
 
 import discord
 from discord.ext import commands
 
+from archive import get_archive
+from locks import get_group_locks
+from registry import get_registry
+from renamequeue import get_rename_queue
+from rolequeue import get_role_queue
+from throttle import throttled
+
 class NullSubcommand(commands.CommandError):
     pass
 
@@ -16,145 +25,256 @@ def check_for_subcommand(ctx):
         return False
     return True
 
-class GroupCog(commands.Cog):
-    def _get_name(self):
-        return self.__name
-    def _get_cmd_name(self):
-        return self.__cmd_name
-    def _set_name(self, val):
-        self.__name = val
-        self.__cmd_name = re.sub(
-            r'[^a-zA-Z0-9]+',
-            r'-',
-            re.sub(r'[\'"`]', '', self.__name.lower())
-        )
-        cmds = self.group.commands
-        self.group.update(name=self.__cmd_name)
-        for c in cmds:
-            self.group.add_command(c)
-    name = property(_get_name, _set_name)
-    group_name = property(_get_name, _set_name)
-    cmd = property(_get_cmd_name)
-
-    def _get_cat_id(self):
-        return self.__cat_id
-    def _set_cat_id(self, val):
-        self.__cat_id = val
-    group_id = property(_get_cat_id, _set_cat_id)
-
-    def _get_member_role_id(self):
-        return self.__member_role_id
-    def _set_member_role_id(self, val):
-        self.__member_role_id = val
-        self.group.add_check(
-            commands.check_any(
-                commands.has_role(self.member_role_id),
-                commands.has_permissions(administrator=True)
-            )
-        )
-        self.leave.add_check(
-            commands.has_role(self.member_role_id)
-        )
-    member_role_id = property(_get_member_role_id, _set_member_role_id)
-
-    def _get_gm_role_id(self):
-        return self.__member_role_id
-    def _set_gm_role_id(self, val):
-        self.__gm_role_id = val
-        self.add.add_check(
-            commands.check_any(
-                commands.has_role(self.gm_role_id),
-                commands.has_permissions(administrator=True)
-            )
-        )
-        self.kick.add_check(
-            commands.check_any(
-                commands.has_role(self.gm_role_id),
-                commands.has_permissions(administrator=True)
-            )
-        )
-        self.add_gm.add_check(
-            commands.check_any(
-                commands.has_role(self.gm_role_id),
-                commands.has_permissions(administrator=True)
-            )
-        )
-        self.resign_gm.add_check(
-            commands.has_role(self.gm_role_id)
-        )
-    gm_role_id = property(_get_gm_role_id, _set_gm_role_id)
-
-    def _get_member_role_name(self):
-        return f'{self.__name} Member'
-    member_role_name = property(_get_member_role_name)
-
-    def _get_gm_role_name(self):
-        return f'{self.__name} GM'
-    gm_role_name = property(_get_gm_role_name)
-
-    def _get_guild(self):
-        return self.__guild
-    def _set_guild(self, val):
-        self.__guild = val
-        member_role = discord.utils.get(self.guild.roles, name=self.member_role_name)
-        gm_role = discord.utils.get(self.guild.roles, name=self.gm_role_name)
-        cat = discord.utils.get(self.guild.categories, name=self.group_name)
-        if not member_role:
-            raise commands.ExtensionFailed(message='No member role for group.')
-        if not gm_role:
-            raise commands.ExtensionFailed(message='No GM role for group.')
-        if not cat:
-            raise commands.ExtensionFailed(message='No category channel for group.')
-        self.member_role_id = member_role.id
-        self.gm_role_id = gm_role.id
-        self.group_id = cat.id
-    guild = property(_get_guild, _set_guild)
-
-    def setup(self, bot, name=None):
-        if name is None:
-            raise commands.ExtensionFailed(message='Group cog not given name.')
-        self.cog_name = name
-        self.name = name
+class NoGroup(commands.CheckFailure):
+    pass
+
+GROUP_COMMAND_NAME = '[group-name]'
+
+def get_group_entry(ctx):
+    """Returns the registry entry of the group a command was invoked for."""
+    entry = getattr(ctx, 'group_entry', None)
+    if entry is None:
+        raise NoGroup(message='No group given.')
+    return entry
+
+def has_group_role(attr):
+    """A check that passes if the author has the group role stored in ``attr``."""
+    def predicate(ctx):
+        role_id = getattr(get_group_entry(ctx), attr)
+        if discord.utils.get(ctx.author.roles, id=role_id) is None:
+            raise commands.MissingRole(role_id)
+        return True
+    return commands.check(predicate)
+
+def requires_group_role(attr, *, admin=False):
+    """Requires the group role stored in ``attr``, or administrator if ``admin``.
+
+    The requirement is also recorded on the callback as ``__group_role__`` so
+    :class:`GroupVisibility` can evaluate it without running the check.
+    """
+    def decorator(func):
+        check = has_group_role(attr)
+        if admin:
+            check = commands.check_any(check, commands.has_permissions(administrator=True))
+        func.__group_role__ = (attr, admin)
+        return check(func)
+    return decorator
+
+def holds_group_lock(func):
+    """Runs a group command while holding its group's lock.
+
+    Commands on one group run one at a time, and fail with :class:`NoGroup`
+    if the group was deleted while they waited.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, ctx, *args, **kwargs):
+        entry = get_group_entry(ctx)
+        async with get_group_locks(ctx.bot).lock(entry.group_id):
+            if get_registry(ctx.bot).get(entry.group_id) is not entry:
+                raise NoGroup(message=f'Group {entry.name} no longer exists.')
+            return await func(self, ctx, *args, **kwargs)
+    return wrapper
+
+def is_group_member():
+    return requires_group_role('member_role_id')
+
+def is_group_gm(*, admin=False):
+    return requires_group_role('gm_role_id', admin=admin)
+
+class GroupVisibility:
+    """The groups and group commands a member can use.
+
+    Built from the member's roles with one lookup per role in the registry's
+    role index, so help never has to run the group checks.
+    """
+    # (admin, member, gm) -> commands allowed, shared by all groups.
+    _allowed = {}
+
+    def __init__(self, cog, registry, guild_id, admin, role_ids):
+        self.cog = cog
+        self.admin = admin
+        self.member_of = set()
+        self.gm_of = set()
+        for role_id in role_ids:
+            entry = registry.get_by_role(role_id)
+            if entry is None:
+                continue
+            if entry.member_role_id == role_id:
+                self.member_of.add(entry.group_id)
+            if entry.gm_role_id == role_id:
+                self.gm_of.add(entry.group_id)
+        if admin:
+            self.groups = registry.entries(guild_id)
+        else:
+            self.groups = [registry.get(i) for i in self.member_of]
+
+    def commands(self, entry):
+        """Returns the group commands usable in ``entry``."""
+        flags = (self.admin, entry.group_id in self.member_of, entry.group_id in self.gm_of)
+        allowed = self._allowed.get(flags)
+        if allowed is None:
+            allowed = self._allowed[flags] = frozenset(self._evaluate(*flags))
+        return allowed
+
+    def _evaluate(self, admin, member, gm):
+        # Mirrors GroupCog.cog_check and the requires_group_role checks.
+        if not (admin or member):
+            return
+        held = {'member_role_id': member, 'gm_role_id': gm}
+        for c in self.cog.walk_commands():
+            rule = getattr(c.callback, '__group_role__', None)
+            if rule is None or held[rule[0]] or (rule[1] and admin):
+                yield c.qualified_name
+
+    def can_run(self, entry, command):
+        if command.parent is not None and not self.can_run(entry, command.parent):
+            return False
+        return command.qualified_name in self.commands(entry)
+
+def get_visibility(ctx):
+    """Returns the :class:`GroupVisibility` of the context's author.
+
+    Results are memoized per guild registry version and snapshot of the
+    author's group roles.
+    """
+    bot = ctx.bot
+    registry = get_registry(bot)
+    admin = ctx.author.guild_permissions.administrator
+    role_ids = frozenset(r.id for r in ctx.author.roles if registry.get_by_role(r.id) is not None)
+    key = (ctx.guild.id, registry.version(ctx.guild.id), admin, role_ids)
+    memo = getattr(bot, 'group_visibility', None)
+    if memo is None:
+        memo = bot.group_visibility = collections.OrderedDict()
+    visibility = memo.get(key)
+    if visibility is None:
+        visibility = memo[key] = GroupVisibility(get_group_cog(bot), registry, ctx.guild.id, admin, role_ids)
+        while len(memo) > 1024:
+            memo.popitem(last=False)
+    else:
+        memo.move_to_end(key)
+    return visibility
+
+class GroupCog(commands.Cog, name='Groups'):
+    """Commands shared by every group.
+
+    One instance serves all groups of all guilds. It is not added to the bot
+    with ``add_cog``; :class:`groupbot.GroupBotMixin` routes ``!<group-name>``
+    to :attr:`group` and puts the group's registry entry on the context as
+    ``ctx.group_entry``.
+    """
+    def __init__(self, bot):
         self.bot = bot
-        if len(bot.guilds) == 0:
-            raise commands.ExtensionFailed(message='Bot has no guilds.')
-        self.guild = bot.get_guild(bot.guilds[0].id)
+        # Group id -> channels moved out of the group while it is being deleted.
+        self._deleting = {}
+        for c in self.walk_commands():
+            c.cog = self
 
     async def cog_check(self, ctx: commands.Context):
-        return ctx.author.guild_permissions.administrator or discord.utils.get(ctx.author.roles, name=self.member_role_name) is not None
-
-    @commands.Cog.listener()
-    async def on_guild_channel_update(self, before, after):
-        if before.id == self.group_id and before.name != after.name:
-            guild = before.guild
-            member_role = discord.utils.get(guild.roles, name=self.member_role_name)
-            gm_role = discord.utils.get(guild.roles, name=self.gm_role_name)
-            self.group_name = after.name
-            await member_role.edit(
-                reason='Group name updated.',
-                name=f'{after.name} Member'
-            )
-            await gm_role.edit(
-                reason='Group name updated.',
-                name=f'{after.name} GM'
-            )
-            print(f'Group name updated to {self.cmd}')
-        elif before.category is not None and before.category.id == self.group_id and (after.category is None or after.category.id != self.group_id):
-            await after.delete()
-
-    @commands.Cog.listener()
-    async def on_guild_channel_delete(self, channel):
-        if channel.id == self.group_id:
-            for c in channel.channels:
+        entry = get_group_entry(ctx)
+        return ctx.author.guild_permissions.administrator or discord.utils.get(ctx.author.roles, id=entry.member_role_id) is not None
+
+    async def ensure_gm(self, guild, entry, leaving):
+        """Makes the longest standing member GM if ``leaving`` was the group's last GM."""
+        members = get_registry(self.bot).members
+        gms = members.count(entry.gm_role_id)
+        if members.holds(entry.gm_role_id, leaving.id):
+            gms -= 1
+        if gms > 0:
+            return None
+        exclude = {leaving.id}
+        while True:
+            user_id = members.successor(entry, exclude)
+            if user_id is None:
+                return None
+            successor = guild.get_member(user_id)
+            if successor is not None:
+                break
+            # Left the guild without the index hearing about it.
+            exclude.add(user_id)
+        gm_role = guild.get_role(entry.gm_role_id)
+        await get_role_queue(self.bot).add_roles(successor, gm_role, reason=f'Succeeded {leaving} as GM of group.')
+        return successor
+
+    def is_deleting(self, group_id):
+        """Whether the group's category was deleted and :meth:`on_group_delete` is cleaning up after it."""
+        return group_id in self._deleting
+
+    async def on_group_update(self, entry, before, after):
+        """Called by :class:`Base` when a group's category is updated.
+
+        Renames are applied once the name has stopped changing, see
+        :class:`renamequeue.RenameQueue`.
+        """
+        if before.name != after.name:
+            get_rename_queue(self.bot).rename(entry, after.name)
+
+    async def on_channel_moved(self, entry, before, after):
+        """Called by :class:`Base` when a channel is moved out of a group.
+
+        Deleting a category moves its channels out of it, those are left to
+        :meth:`on_group_delete`.
+        """
+        moved = self._deleting.get(entry.group_id)
+        if moved is not None:
+            moved.append(after)
+            return
+        if after.guild.get_channel(entry.group_id) is None:
+            return
+        await after.delete()
+
+    async def on_group_delete(self, entry, channel):
+        """Called by :class:`Base` when a group's category is deleted.
+
+        The group's text channels are archived before they are deleted, and
+        kept if that fails. Holds the group's lock, so commands on the group
+        that are waiting for it fail once it is gone.
+
+        Discord also moves the channels out of the deleted category, possibly
+        before this runs. Channels reported by :meth:`on_channel_moved` until
+        the group is forgotten are handled the same way.
+        """
+        moved = self._deleting[entry.group_id] = []
+        seen = set()
+        async def delete_channels(channels):
+            while channels:
+                seen.update(c.id for c in channels)
+                await self._delete_channels(entry, channel, channels)
+                channels = [c for c in moved if c.id not in seen]
+                moved.clear()
+        try:
+            get_rename_queue(self.bot).cancel(entry)
+            async with get_group_locks(self.bot).lock(entry.group_id):
+                await delete_channels(channel.channels)
+                guild = channel.guild
+                member_role = guild.get_role(entry.member_role_id)
+                gm_role = guild.get_role(entry.gm_role_id)
+                for role in (member_role, gm_role):
+                    if role is not None:
+                        try:
+                            await role.delete()
+                        except discord.NotFound:
+                            pass
+                await delete_channels([c for c in moved if c.id not in seen])
+                get_registry(self.bot).remove(entry)
+        finally:
+            del self._deleting[entry.group_id]
+
+    async def _delete_channels(self, entry, category, channels):
+        """Archives and deletes ``channels`` of a deleted group, keeping those that could not be archived."""
+        archive = get_archive(self.bot)
+        if archive is not None:
+            _, failed = await archive.channels(channels, category=category)
+            for c, e in failed:
+                print(f'Keeping #{c.name} of {entry.name}, could not archive it: {e}')
+                channels.remove(c)
+        for c in channels:
+            try:
                 await c.delete()
-            guild = channel.guild
-            member_role = discord.utils.get(guild.roles, name=self.member_role_name)
-            gm_role = discord.utils.get(guild.roles, name=self.gm_role_name)
-            await member_role.delete()
-            await gm_role.delete()
-            self.bot.remove_cog(self.cog_name)
+            except discord.NotFound:
+                pass
 
     @commands.group(
+        name=GROUP_COMMAND_NAME,
         description='Provides commands for a specific group.',
         brief='Commands for specific TTRPG groups'
     )
@@ -169,15 +289,18 @@ class GroupCog(commands.Cog):
         description='Add member(s) to group.',
         brief='Add member(s)'
     )
+    @is_group_gm(admin=True)
+    @throttled(cost=lambda self, ctx, users: len(users), concurrency=None)
+    @holds_group_lock
     async def add(self, ctx, users: commands.Greedy[discord.Member]): # commands.Greedy[discord.Member]
         """Add a new member or members to the group.
 
         **Args:**
         `users` Users to add to group.
         """
-        member_role = discord.utils.get(ctx.guild.roles, name=self.member_role_name)
-        for user in users:
-            await user.add_roles(member_role)
+        member_role = ctx.guild.get_role(get_group_entry(ctx).member_role_id)
+        queue = get_role_queue(self.bot)
+        await asyncio.gather(*(queue.add_roles(user, member_role, reason='Added to group.') for user in users))
         # if user is None:
         #     await ctx.send_help(ctx.command)
         #     raise commands.BadArgument(message='No user provided.')
@@ -189,6 +312,9 @@ class GroupCog(commands.Cog):
         description='Remove member from group.',
         brief='Remove member'
     )
+    @is_group_gm(admin=True)
+    @throttled(concurrency=None)
+    @holds_group_lock
     async def kick(self, ctx, user: discord.Member = None):
         """Remove member from the group.
         *Only accessible to GMs of group.*
@@ -202,25 +328,50 @@ class GroupCog(commands.Cog):
         if user == ctx.author:
             await ctx.send_help(ctx.command)
             raise commands.BadArgument(message='Cannot kick self.')
-        member_role = discord.utils.get(ctx.guild.roles, name=self.member_role_name)
-        gm_role = discord.utils.get(ctx.guild.roles, name=self.gm_role_name)
-        await user.remove_roles(member_role, gm_role, reason='Kicked from group.')
+        entry = get_group_entry(ctx)
+        member_role = ctx.guild.get_role(entry.member_role_id)
+        gm_role = ctx.guild.get_role(entry.gm_role_id)
+        await get_role_queue(self.bot).remove_roles(user, member_role, gm_role, reason='Kicked from group.')
 
     @group.command(
         name='leave',
         description='Remove self from group.',
         brief='Leave group'
     )
+    @is_group_member()
+    @throttled(concurrency=None)
+    @holds_group_lock
     async def leave(self, ctx):
         """Remove yourself from the group."""
         u = ctx.author
-        member_role = discord.utils.get(ctx.guild.roles, name=self.member_role_name)
-        gm_role = discord.utils.get(ctx.guild.roles, name=self.gm_role_name)
-        await u.remove_roles(member_role, gm_role, reason='Requested to leave group.')
-        members = member_role.members
-        gms = gm_role.members
-        if len(gms) == 0 and len(members) > 0:
-          members[0].add_roles(gm_role)
+        entry = get_group_entry(ctx)
+        member_role = ctx.guild.get_role(entry.member_role_id)
+        gm_role = ctx.guild.get_role(entry.gm_role_id)
+        await get_role_queue(self.bot).remove_roles(u, member_role, gm_role, reason='Requested to leave group.')
+        await self.ensure_gm(ctx.guild, entry, leaving=u)
+
+    @group.command(
+        name='archive',
+        description='Archive the group\'s text channels.',
+        brief='Archive channels'
+    )
+    @is_group_gm(admin=True)
+    @throttled(cost=2)
+    async def archive(self, ctx):
+        """Save the history of the group's text channels on the bot's host.
+        Only messages since the last archive are added.
+        *Only accessible to GMs of the group.*
+        """
+        archive = get_archive(self.bot)
+        if archive is None:
+            raise commands.CommandError(message='Archiving is turned off.')
+        category = ctx.guild.get_channel(get_group_entry(ctx).group_id)
+        status = await ctx.send(f'Archiving {category.name}...')
+        archived, failed = await archive.channels(category.channels, category=category)
+        content = f'Archived {sum(archived.values())} new messages from {len(archived)} channels.'
+        if failed:
+            content += '\nFailed: ' + ', '.join(f'#{c.name} ({e})' for c, e in failed)
+        await status.edit(content=content[:2000])
 
     @group.group(
         name='gm',
@@ -228,7 +379,7 @@ class GroupCog(commands.Cog):
         brief='GM specific commands'
     )
     #@commands.check(check_for_subcommand)
-    async def gm_group(ctx):
+    async def gm_group(self, ctx):
         """Provides GM specific commands for the group."""
         if ctx.invoked_subcommand is None:
             await ctx.send_help(ctx.command)
@@ -239,7 +390,10 @@ class GroupCog(commands.Cog):
         description='Add a user as a GM.',
         brief='Add GM'
     )
-    async def add_gm(ctx, user: discord.Member = None):
+    @is_group_gm(admin=True)
+    @throttled(concurrency=None)
+    @holds_group_lock
+    async def add_gm(self, ctx, user: discord.Member = None):
         """Add member as GM of the group.
         *Only accessible to GMs of the group.*
 
@@ -248,31 +402,33 @@ class GroupCog(commands.Cog):
         """
         if user is None:
             raise commands.BadArgument(message='No user provided.')
-        member_role = discord.utils.get(ctx.guild.roles, name=self.member_role)
-        gm_role = discord.utils.get(ctx.guild.roles, name=self.gm_role)
-        await user.add_roles(member_role, gm_role, reason='Made GM of group.')
+        entry = get_group_entry(ctx)
+        member_role = ctx.guild.get_role(entry.member_role_id)
+        gm_role = ctx.guild.get_role(entry.gm_role_id)
+        await get_role_queue(self.bot).add_roles(user, member_role, gm_role, reason='Made GM of group.')
 
     @gm_group.command(
         name='resign',
         description='Remove self as GM of group.',
         brief='Remove self as GM'
     )
-    async def resign_gm(ctx):
+    @is_group_gm()
+    @throttled(concurrency=None)
+    @holds_group_lock
+    async def resign_gm(self, ctx):
         """Remove self as GM of the group.
         *Only accessible to GMs of the group.*
         """
         u = ctx.author
-        member_role = ctx.guild.get_role(self.member_role_id)
-        gm_role = ctx.guild.get_role(self.gm_role_id)
-        await u.remove_roles(gm_role, reason='Resigned as GM of group.')
-        members = member_role.members
-        gms = gm_role.members
-        if len(gms) == 0 and len(members) > 0:
-          members[0].add_roles(gm_role)
-
-
-def make_cog(group_name):
-    class Cog(GroupCog, name=group_name):
-        def __init__(self, bot):
-            self.setup(bot, group_name)
-    return Cog
+        entry = get_group_entry(ctx)
+        gm_role = ctx.guild.get_role(entry.gm_role_id)
+        await get_role_queue(self.bot).remove_roles(u, gm_role, reason='Resigned as GM of group.')
+        await self.ensure_gm(ctx.guild, entry, leaving=u)
+
+
+def get_group_cog(bot):
+    """Returns the group cog attached to ``bot``, creating it if needed."""
+    cog = getattr(bot, 'group_cog', None)
+    if cog is None:
+        cog = bot.group_cog = GroupCog(bot)
+    return cog
@@ -0,0 +1,110 @@
+import time
+
+from discord.ext import commands
+
+from cogfactory import get_group_cog
+from loopmonitor import get_loop_monitor
+from metrics import get_metrics
+from reconcile import get_reconciler
+from renamequeue import get_rename_queue
+from registry import get_registry
+from rolequeue import get_role_queue
+from tracing import get_tracer
+
+__all__ = ['GroupBotMixin', 'GroupBot', 'AutoShardedGroupBot']
+
+def _resolve_command(ctx):
+    """Returns the subcommand ``ctx`` will run, found the way :meth:`commands.Group.invoke` does."""
+    command = ctx.command
+    view = ctx.view
+    index, previous = view.index, view.previous
+    try:
+        while isinstance(command, commands.Group):
+            view.skip_ws()
+            subcommand = command.all_commands.get(view.get_word())
+            if subcommand is None:
+                break
+            command = subcommand
+    finally:
+        view.index, view.previous = index, previous
+    return command
+
+class GroupBotMixin:
+    """Adds per-guild group commands to a :class:`commands.Bot`.
+
+    Groups are not registered as commands. Instead the invoked name is looked
+    up in the group registry for the guild the message came from and, if it
+    names a group, dispatched to the shared :class:`cogfactory.GroupCog`
+    command with the group's entry on ``ctx.group_entry``.
+
+    Every invocation is timed into the bot's :class:`metrics.Metrics`, and
+    commands and listeners are traced by its :class:`tracing.Tracer` and
+    labelled for its :class:`loopmonitor.LoopMonitor`.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        get_metrics(self)
+        get_tracer(self)
+    async def get_context(self, message, *, cls=commands.Context):
+        ctx = await super().get_context(message, cls=cls)
+        if ctx.command is None and ctx.invoked_with and message.guild is not None:
+            entry = get_registry(self).get_by_cmd(message.guild.id, ctx.invoked_with)
+            if entry is not None:
+                ctx.command = get_group_cog(self).group
+                ctx.group_entry = entry
+        return ctx
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        entry = getattr(ctx, 'group_entry', None)
+        # Labelled with the subcommand up front, so lag while its checks and
+        # converters run is blamed on it rather than on its group.
+        name = f'command {_resolve_command(ctx).qualified_name}'
+        span = get_tracer(self).span(
+            name,
+            guild_id=ctx.guild.id if ctx.guild else None,
+            group=entry.cmd if entry is not None else None,
+            message_id=ctx.message.id
+        )
+        start = time.perf_counter()
+        try:
+            with get_loop_monitor(self).label(name), span:
+                await super().invoke(ctx)
+                # Like the metrics, the span is named after the command that ran.
+                span.rename(f'command {ctx.command.qualified_name}')
+                span.set(failed=ctx.command_failed)
+        finally:
+            get_metrics(self).observe_command(ctx, time.perf_counter() - start)
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        tracer = get_tracer(self)
+        monitor = get_loop_monitor(self)
+        if tracer.enabled or monitor.running:
+            listener = coro
+            async def coro(*args, **kwargs):
+                name = listener.__qualname__
+                with monitor.label(name), tracer.span(f'event {event_name}', root=True, listener=name):
+                    await listener(*args, **kwargs)
+        await super()._run_event(coro, event_name, *args, **kwargs)
+
+    async def start(self, *args, **kwargs):
+        await get_metrics(self).start()
+        get_loop_monitor(self).start()
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        # Apply queued role changes and renames before the connection goes away.
+        await get_role_queue(self).flush()
+        await get_rename_queue(self).flush()
+        await get_metrics(self).stop()
+        get_loop_monitor(self).stop()
+        get_reconciler(self).stop()
+        await super().close()
+        get_tracer(self).close()
+
+class GroupBot(GroupBotMixin, commands.Bot):
+    pass
+
+class AutoShardedGroupBot(GroupBotMixin, commands.AutoShardedBot):
+    pass
@@ -1,13 +1,16 @@
 # help.py
 from discord.ext import commands as cmds
 import discord
+import asyncio
+import collections
 import itertools
 import re
 
 from colors import random_color
-from cogfactory import GroupCog
+from cogfactory import GROUP_COMMAND_NAME, GroupCog, get_group_cog, get_visibility
+from registry import get_registry
 
-__all__ = ['MyHelpCommand', 'EmbedPaginator']
+__all__ = ['MyHelpCommand', 'EmbedPaginator', 'HelpCache', 'get_help_cache']
 
 class EmbedPaginator: #(cmds.Paginator):
     # EMBEDED LIMITS:
@@ -61,19 +64,39 @@ class EmbedPaginator: #(cmds.Paginator):
         self.footer_icon_url = icon_url
         self._base_count += len(footer) + 1 # footer + newline
 
+    # Field values are kept as lists of lines with a running length and are
+    # only joined once, when their page is closed.
+    def _new_field(self, name):
+        self._current_page['fields'].append({ 'inline': False, 'name': name, 'parts': [''], 'length': 0 })
+
+    def _extend(self, text):
+        """Appends a newline and ``text`` to the last field."""
+        field = self._current_page['fields'][-1]
+        field['parts'].append(text)
+        field['length'] += len(text) + 1
+
+    def _put(self, text):
+        """Appends ``text`` to the last field, after a newline if it isn't empty."""
+        field = self._current_page['fields'][-1]
+        if field['length'] == 0:
+            field['parts'] = [text]
+            field['length'] = len(text)
+        else:
+            self._extend(text)
+
     def set_prefix(self, prefix=None):
         self.prefix = prefix
         if len(self._current_page['fields']) > 0:
-            if len(self._current_page['fields'][-1]['value']) == 0:
-                self._current_page['fields'][-1]['value'] += prefix
+            if self._current_page['fields'][-1]['length'] == 0:
+                self._put(prefix)
                 self._count += len(prefix) + 1
             else:
-                self._current_page['fields'][-1]['value'] += '\n%s' % (prefix)
+                self._extend(prefix)
                 self._count += len(prefix) + 2 # prefix + 2*newline
 
     def set_suffix(self, suffix=None):
         if self.suffix is not None and len(self._current_page['fields']) > 0:
-            self._current_page['fields'][-1]['value'] += '\n%s' % (self.suffix)
+            self._extend(self.suffix)
             self._count += len(self.suffix) + 1
         self.suffix = suffix
 
@@ -82,14 +105,10 @@ class EmbedPaginator: #(cmds.Paginator):
 
     def clear_suffix(self):
         if self.suffix is not None and len(self._current_page['fields']) > 0:
-            self._current_page['fields'][-1]['value'] += '\n%s' % (self.suffix)
+            self._extend(self.suffix)
             self._count += len(self.suffix) + 1
         self.suffix = None
 
-    @property
-    def _suffix_len(self):
-        return len(self.suffix) if self.suffix else 0
-
     @property
     def _prefix_len(self):
         return len(self.prefix) if self.prefix else 0
@@ -100,7 +119,11 @@ class EmbedPaginator: #(cmds.Paginator):
 
     def close_page(self):
         if self.suffix is not None and len(self._current_page['fields']) > 0:
-            self._current_page['fields'][-1]['value'] += '\n%s' % (self.suffix)
+            self._extend(self.suffix)
+        self._current_page['fields'] = [
+            { 'inline': f['inline'], 'name': f['name'], 'value': '\n'.join(f['parts']) }
+            for f in self._current_page['fields']
+        ]
         if self.title is not None:
             self._current_page['title'] = self.title
             if len(self._pages) > 0:
@@ -125,13 +148,13 @@ class EmbedPaginator: #(cmds.Paginator):
             raise RuntimeError('Field name exceeds maximum size 250')
 
         if self.suffix is not None and len(self._current_page['fields']) > 0:
-            self._current_page['fields'][-1]['value'] += '\n%s' % (self.suffix)
+            self._extend(self.suffix)
             self._count += len(self.suffix) + 1
 
         if self._count + self._base_count + len(name) + 1 > self.max_size - self._suffix_len or len(self._current_page['fields']) == 25:
             self.close_page()
 
-        self._current_page['fields'].append({ 'inline': False, 'name': name, 'value': '' })
+        self._new_field(name)
         self._count += len(name) + 1
 
     def add_line(self, line='', *, empty=False):
@@ -143,33 +166,79 @@ class EmbedPaginator: #(cmds.Paginator):
             self.close_page()
 
         if len(self._current_page['fields']) == 0:
-            self._current_page['fields'].append({ 'inline': False, 'name': '\u200b', 'value': '' })
+            self._new_field('\u200b')
             self._count += 1
-        elif len(self._current_page['fields'][-1]['value']) + len(line) + self._suffix_len + 1 >= 1024:
+        elif self._current_page['fields'][-1]['length'] + len(line) + self._suffix_len + 1 >= 1024:
             self.add_name()
 
-        if len(self._current_page['fields'][-1]['value']) == 0 and self.prefix:
-            self._current_page['fields'][-1]['value'] += self.prefix
+        if self._current_page['fields'][-1]['length'] == 0 and self.prefix:
+            self._put(self.prefix)
             self._count += len(self.prefix) + 1
 
-        if len(self._current_page['fields'][-1]['value']) == 0:
-            self._current_page['fields'][-1]['value'] += line
+        if self._current_page['fields'][-1]['length'] == 0:
+            self._put(line)
             self._count += len(line)
         else:
-            self._current_page['fields'][-1]['value'] += '\n%s' % (line)
+            self._extend(line)
             self._count += len(line) + 1
 
         if empty:
-            self._current_page['fields'][-1]['value'] += '\n'
+            self._extend('')
             self._count += 1
 
     @property
-    def pages(self):
-        """Returns the rendered list of pages."""
+    def raw_pages(self):
+        """Returns the list of pages as embed dicts."""
         # we have more than just the prefix in our current page
         if self._count > (0 if self.prefix is None else self._prefix_len + 1):
             self.close_page()
-        return list(map(lambda p : discord.Embed.from_dict(p), self._pages))
+        return list(self._pages)
+
+    @property
+    def pages(self):
+        """Returns the rendered list of pages."""
+        return list(map(lambda p : discord.Embed.from_dict(p), self.raw_pages))
+
+class HelpCache:
+    """LRU cache of rendered help pages.
+
+    Keys hold everything that changes what help shows: the target, the loaded
+    cogs, the guild's group registry version and the author's permissions and
+    group roles. A change to any of those produces a new key, so stale pages
+    are never served and simply age out.
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._pages = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, key):
+        pages = self._pages.get(key)
+        if pages is not None:
+            self._pages.move_to_end(key)
+        return pages
+
+    def set(self, key, pages):
+        self._pages[key] = pages
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.max_size:
+            self._pages.popitem(last=False)
+
+    def clear(self):
+        self._pages.clear()
+
+def get_help_cache(bot):
+    """Returns the help cache attached to ``bot``, creating it if needed.
+
+    The cache can't live on the help command itself since discord.py copies
+    the help command for every invocation.
+    """
+    cache = getattr(bot, 'help_cache', None)
+    if cache is None:
+        cache = bot.help_cache = HelpCache()
+    return cache
 
 class MyHelpCommand(cmds.HelpCommand):
     """The implementation of the default help command.
@@ -202,8 +271,20 @@ class MyHelpCommand(cmds.HelpCommand):
         Useful for i18n. Defaults to ``"No Category"``
     paginator: :class:`Paginator`
         The paginator used to paginate the help command output.
+    navigate: :class:`bool`
+        Whether help with several pages is sent as one message whose page is
+        changed with reactions, rather than one message per page.
+        Defaults to ``True``.
+    navigation_timeout: :class:`float`
+        How many seconds a navigable help message keeps its pages and reacts
+        to page changes, counted from when it was sent. Defaults to ``120``.
     """
 
+    previous_page = '\u25c0'
+    next_page = '\u25b6'
+    # Navigation tasks still running, shared by the copies made per invocation.
+    _navigations = set()
+
     def __init__(self, **options):
         self.width = options.pop('width', 80)
         self.indent = options.pop('indent', 2)
@@ -213,6 +294,8 @@ class MyHelpCommand(cmds.HelpCommand):
         self.commands_heading = options.pop('commands_heading', "Commands:")
         self.no_category = options.pop('no_category', 'No Category')
         self.paginator = options.pop('paginator', None)
+        self.navigate = options.pop('navigate', True)
+        self.navigation_timeout = options.pop('navigation_timeout', 120)
         options['verify_checks'] = True
 
         if self.paginator is None:
@@ -253,10 +336,175 @@ class MyHelpCommand(cmds.HelpCommand):
             else:
                 self.paginator.add_line(self.shorten_text(entry))
 
-    async def send_pages(self):
+    def get_group_entries(self):
+        """Returns the groups of the current guild the author can use."""
+        if self.context.guild is None:
+            return []
+        return list(get_visibility(self.context).groups)
+
+    async def filter_commands(self, commands, *, sort=False, key=None):
+        """Filters group commands with :class:`GroupVisibility` instead of running their checks."""
+        commands = list(commands)
+        group_cmds = [c for c in commands if isinstance(c.cog, GroupCog)]
+        if not group_cmds:
+            return await super().filter_commands(commands, sort=sort, key=key)
+        others = await super().filter_commands([c for c in commands if not isinstance(c.cog, GroupCog)])
+        entry = getattr(self.context, 'group_entry', None)
+        if entry is not None and self.context.guild is not None:
+            visibility = get_visibility(self.context)
+            others.extend(c for c in group_cmds if not c.hidden and visibility.can_run(entry, c))
+        if sort:
+            others.sort(key=key or (lambda c: c.name))
+        return others
+
+    def get_display_name(self, command):
+        """Returns the qualified name of a command with the group name filled in."""
+        name = command.qualified_name
+        entry = getattr(self.context, 'group_entry', None)
+        if entry is not None and isinstance(command.cog, GroupCog):
+            name = name.replace(GROUP_COMMAND_NAME, entry.cmd, 1)
+        return name
+
+    def get_command_signature(self, command):
+        signature = super().get_command_signature(command)
+        entry = getattr(self.context, 'group_entry', None)
+        if entry is not None and isinstance(command.cog, GroupCog):
+            signature = signature.replace(GROUP_COMMAND_NAME, entry.cmd, 1)
+        return signature
+
+    _cache_key = None
+
+    def get_cache_key(self, command):
+        """Returns the help cache key for ``command`` as the current author sees it."""
+        ctx = self.context
+        key = (command or '', tuple(ctx.bot.cogs))
+        if ctx.guild is None:
+            return key
+        registry = get_registry(ctx.bot)
+        role_ids = frozenset(r.id for r in ctx.author.roles if registry.get_by_role(r.id) is not None)
+        return key + (
+            ctx.guild.id,
+            registry.version(ctx.guild.id),
+            ctx.author.guild_permissions.administrator,
+            role_ids
+        )
+
+    async def command_callback(self, ctx, *, command=None):
+        self._cache_key = self.get_cache_key(command)
+        pages = get_help_cache(ctx.bot).get(self._cache_key)
+        if pages is not None:
+            await self.prepare_help_command(ctx, command)
+            return await self.send_embeds(self.restamp_pages(pages))
+
+        # Group commands are not registered on the bot, so resolve them per guild.
+        if command is not None and ctx.guild is not None:
+            keys = command.split(' ')
+            entry = get_registry(ctx.bot).get_by_cmd(ctx.guild.id, keys[0])
+            if entry is not None:
+                ctx.group_entry = entry
+                await self.prepare_help_command(ctx, command)
+                cmd = get_group_cog(ctx.bot).group
+                for key in keys[1:]:
+                    found = cmd.all_commands.get(key) if isinstance(cmd, cmds.Group) else None
+                    if found is None:
+                        string = await discord.utils.maybe_coroutine(self.subcommand_not_found, cmd, self.remove_mentions(key))
+                        return await self.send_error_message(string)
+                    cmd = found
+                if isinstance(cmd, cmds.Group):
+                    return await self.send_group_help(cmd)
+                return await self.send_command_help(cmd)
+        return await super().command_callback(ctx, command=command)
+
+    def restamp_pages(self, pages):
+        """Builds embeds from cached pages with the current author's footer."""
+        footer = { 'text': self.paginator.footer }
+        if self.paginator.footer_icon_url is not None:
+            footer['icon_url'] = self.paginator.footer_icon_url
+        return [discord.Embed.from_dict(dict(p, footer=footer)) for p in pages]
+
+    async def send_embeds(self, embeds):
+        embeds = list(embeds)
         destination = self.get_destination()
-        for page in self.paginator.pages:
-            await destination.send(embed=page)
+        if not self.navigate or len(embeds) < 2:
+            for embed in embeds:
+                await destination.send(embed=embed)
+            return
+        for i, embed in enumerate(embeds):
+            embed.set_footer(
+                text=f'{embed.footer.text or ""} \u2022 Page {i + 1}/{len(embeds)}',
+                icon_url=embed.footer.icon_url
+            )
+        message = await destination.send(embed=embeds[0])
+        try:
+            await message.add_reaction(self.previous_page)
+            await message.add_reaction(self.next_page)
+        except discord.HTTPException:
+            # No permission to react, fall back to one message per page.
+            for embed in embeds[1:]:
+                await destination.send(embed=embed)
+            return
+        # The pages live only as long as this task, which ends after the timeout.
+        task = asyncio.ensure_future(self.navigate_pages(message, embeds))
+        self._navigations.add(task)
+        task.add_done_callback(self._navigation_done)
+
+    @classmethod
+    def _navigation_done(cls, task):
+        cls._navigations.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f'Help page navigation failed: {task.exception()!r}')
+
+    async def navigate_pages(self, message, embeds):
+        """Edits ``message`` to the previous or next page as the author reacts."""
+        bot = self.context.bot
+        author = self.context.author
+        controls = (self.previous_page, self.next_page)
+        page = 0
+        loop = asyncio.get_event_loop()
+        # Reactions do not extend it, so nobody can keep the pages alive forever.
+        deadline = loop.time() + self.navigation_timeout
+
+        def check(reaction, user):
+            return reaction.message.id == message.id and user.id == author.id and str(reaction.emoji) in controls
+
+        while True:
+            # Removing the author's reaction needs permissions we may not have,
+            # so taking a reaction away also turns the page.
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            waiters = [
+                asyncio.ensure_future(bot.wait_for('reaction_add', check=check)),
+                asyncio.ensure_future(bot.wait_for('reaction_remove', check=check))
+            ]
+            try:
+                done, _ = await asyncio.wait(
+                    waiters,
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                for w in waiters:
+                    w.cancel()
+            if not done:
+                break
+            reaction, user = done.pop().result()
+            step = -1 if str(reaction.emoji) == self.previous_page else 1
+            page = (page + step) % len(embeds)
+            try:
+                await message.edit(embed=embeds[page])
+            except discord.HTTPException:
+                break
+        try:
+            await message.clear_reactions()
+        except discord.HTTPException:
+            pass
+
+    async def send_pages(self):
+        pages = self.paginator.raw_pages
+        if self._cache_key is not None:
+            get_help_cache(self.context.bot).set(self._cache_key, pages)
+        await self.send_embeds(map(discord.Embed.from_dict, pages))
 
     def add_command_formatting(self, command):
         """A utility function to format the non-indented block of commands and groups.
@@ -266,7 +514,7 @@ class MyHelpCommand(cmds.HelpCommand):
             The command to format.
         """
 
-        self.paginator.set_title(f'Command Help "{command.qualified_name}"')
+        self.paginator.set_title(f'Command Help "{self.get_display_name(command)}"')
 
         if command.description:
             self.paginator.set_description(command.description)
@@ -324,11 +572,12 @@ class MyHelpCommand(cmds.HelpCommand):
             return cog.qualified_name + 'Commands' if cog is not None else no_category
 
         filtered = await self.filter_commands(bot.commands, sort=True, key=get_category)
-        group_cmds = [c for c in filtered if isinstance(c.cog, GroupCog)]
-        group_cmd = group_cmds[0] if len(group_cmds) > 0 else None
-        filtered = [c for c in filtered if not isinstance(c.cog, GroupCog)]
-        if group_cmd is not None:
-            filtered.append(group_cmd)
+        group_entries = sorted(self.get_group_entries(), key=lambda e: e.cmd)
+        if group_entries:
+            # Show the shared group commands as the first group sees them.
+            if getattr(ctx, 'group_entry', None) is None:
+                ctx.group_entry = group_entries[0]
+            filtered.extend(await self.filter_commands([get_group_cog(bot).group]))
         max_size = self.get_max_size(filtered)
         to_iterate = itertools.groupby(filtered, key=get_category)
 
@@ -343,8 +592,8 @@ class MyHelpCommand(cmds.HelpCommand):
         self.paginator.clear_suffix()
 
         self.paginator.add_name('Groups')
-        for c in group_cmds:
-            self.paginator.add_line(f'**{c.cog.name}**: `{c.cog.cmd}`')
+        for e in group_entries:
+            self.paginator.add_line(f'**{e.name}**: `{e.cmd}`')
 
         # cogs = list(filter(lambda c: isinstance(c, GroupCog), bot.cogs.values()))
         # self.paginator.add_line('Groups:')
@@ -0,0 +1,73 @@
+import asyncio
+import contextlib
+
+__all__ = ['KeyedLocks', 'SingleFlight', 'get_group_locks']
+
+class SingleFlight:
+    """Runs at most one call per key at a time and shares its result.
+
+    A call made while another call with the same key is in flight waits for
+    that call and gets its result, or its exception, instead of running.
+    """
+    def __init__(self):
+        self._flights = {}
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    async def run(self, key, func, *args, **kwargs):
+        flight = self._flights.get(key)
+        if flight is not None:
+            # Shielded so a cancelled follower does not cancel the call.
+            return await asyncio.shield(flight)
+        flight = self._flights[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            # Followers re-raise it; without any it must not be reported as lost.
+            flight.exception()
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+
+class KeyedLocks:
+    """An :class:`asyncio.Lock` per key, forgotten once nobody holds or waits for it."""
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key):
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        lock, users = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+def get_group_locks(bot):
+    """Returns the per-group locks of ``bot``, keyed by category id, creating them if needed."""
+    locks = getattr(bot, 'group_locks', None)
+    if locks is None:
+        locks = bot.group_locks = KeyedLocks()
+    return locks
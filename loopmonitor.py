@@ -0,0 +1,187 @@
+import asyncio
+import collections
+import contextlib
+import heapq
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import get_metrics
+
+__all__ = ['LoopMonitor', 'SlowStep', 'get_loop_monitor']
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+class SlowStep:
+    """A stretch of time during which the event loop did not get to run anything else."""
+    __slots__ = ('label', 'lag', 'when', 'stack')
+
+    def __init__(self, label, lag, when, stack):
+        self.label = label
+        self.lag = lag
+        self.when = when
+        self.stack = stack
+
+    def __lt__(self, other):
+        return self.lag < other.lag
+
+    @property
+    def where(self):
+        """The innermost frame, and the innermost frame of the bot's own code if that is another one."""
+        if not self.stack:
+            return 'unknown'
+        def describe(frame):
+            if frame.filename.startswith(ROOT):
+                filename = os.path.relpath(frame.filename, ROOT)
+            else:
+                filename = os.path.basename(frame.filename)
+            return f'{filename}:{frame.lineno} in {frame.name}'
+        where = describe(self.stack[-1])
+        for frame in reversed(self.stack):
+            # The wrappers in groupbot.py are on every command's and listener's stack.
+            if frame.filename.startswith(ROOT) and not frame.filename.endswith('groupbot.py'):
+                if frame is not self.stack[-1]:
+                    where += f' via {describe(frame)}'
+                break
+        return where
+
+class LoopMonitor:
+    """Measures event loop lag and catches the code that caused it.
+
+    A task wakes up every ``interval`` seconds and records how late it woke.
+    A watchdog thread notices when the loop has not woken for ``threshold``
+    seconds past that and captures what the loop thread is running: its stack
+    and the command or listener of the current task, as labelled with
+    :meth:`label`. Steps of at least ``threshold`` seconds are printed and the
+    ``keep`` slowest are kept for :meth:`worst`.
+    """
+    def __init__(self, bot, interval=0.05, threshold=0.1, keep=20):
+        self.bot = bot
+        self.interval = interval
+        self.threshold = threshold
+        self.keep = keep
+        self.lags = collections.deque(maxlen=int(60 / interval))
+        self.recent = collections.deque(maxlen=100)
+        self.by_label = {}
+        self._worst = []
+        self._labels = {}
+        self._beat = None
+        self._capture = None
+        self._task = None
+        self._stopping = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    @contextlib.contextmanager
+    def label(self, label):
+        """Blames ``label`` for anything the current task blocks the loop with."""
+        task = asyncio.current_task()
+        previous = self._labels.get(task)
+        self._labels[task] = label
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._labels.pop(task, None)
+            else:
+                self._labels[task] = previous
+
+    def start(self):
+        if self._task is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self._beat = time.monotonic()
+        self._stopping = threading.Event()
+        self._task = loop.create_task(self._sample())
+        threading.Thread(
+            target=self._watch,
+            args=(loop, threading.get_ident(), self._stopping),
+            name='loop-monitor',
+            daemon=True
+        ).start()
+
+    def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        self._stopping.set()
+
+    async def _sample(self):
+        lag_histogram = get_metrics(self.bot).loop_lag
+        while True:
+            beat = self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - beat - self.interval)
+            self.lags.append(lag)
+            lag_histogram.observe(lag)
+            if lag >= self.threshold:
+                capture = self._capture
+                if capture is not None and capture[0] == beat:
+                    _, label, stack = capture
+                else:
+                    label, stack = 'unknown', []
+                self._record(SlowStep(label, lag, time.time(), stack))
+
+    def _watch(self, loop, thread_id, stopping):
+        captured = None
+        while not stopping.wait(self.threshold / 4):
+            beat = self._beat
+            if beat == captured or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            captured = beat
+            frame = sys._current_frames().get(thread_id)
+            stack = traceback.extract_stack(frame) if frame is not None else []
+            self._capture = (beat, self._describe(loop), stack)
+
+    def _describe(self, loop):
+        # Read from the watchdog thread; both lookups are single dict reads.
+        task = getattr(asyncio.tasks, '_current_tasks', {}).get(loop)
+        if task is None:
+            return 'callback'
+        label = self._labels.get(task)
+        if label is not None:
+            return label
+        coro = task.get_coro()
+        return getattr(coro, '__qualname__', repr(coro))
+
+    def _record(self, step):
+        print(f'Event loop blocked for {step.lag * 1000:.0f}ms by {step.label} at {step.where}')
+        self.recent.append(step)
+        count, total, worst = self.by_label.get(step.label, (0, 0.0, 0.0))
+        self.by_label[step.label] = (count + 1, total + step.lag, max(worst, step.lag))
+        get_metrics(self.bot).slow_steps[step.label] += 1
+        if len(self._worst) < self.keep:
+            heapq.heappush(self._worst, step)
+        else:
+            heapq.heappushpop(self._worst, step)
+
+    def worst(self):
+        """Returns the slowest steps seen, slowest first."""
+        return sorted(self._worst, reverse=True)
+
+    def summary(self):
+        """Returns the lag percentiles of the last minute."""
+        lags = sorted(self.lags)
+        if not lags:
+            return {}
+        def at(p):
+            return lags[min(len(lags) - 1, int(len(lags) * p / 100))]
+        return {'p50': at(50), 'p99': at(99), 'max': lags[-1]}
+
+    def reset(self):
+        self.lags.clear()
+        self.recent.clear()
+        self.by_label.clear()
+        self._worst = []
+
+def get_loop_monitor(bot):
+    """Returns the loop monitor attached to ``bot``, creating it if needed."""
+    monitor = getattr(bot, 'loop_monitor', None)
+    if monitor is None:
+        monitor = bot.loop_monitor = LoopMonitor(bot)
+    return monitor
@@ -0,0 +1,232 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+from aiohttp import web
+
+from registry import get_registry
+
+__all__ = ['Histogram', 'Metrics', 'get_metrics']
+
+# Seconds, from a fast cached reply up to a large teardown.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels.items()
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+class Histogram:
+    """A cumulative histogram in the shape Prometheus expects."""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self, name, **labels):
+        lines = []
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {total}')
+        lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {self.count}')
+        lines.append(f'{name}_sum{_labels(**labels)} {self.sum}')
+        lines.append(f'{name}_count{_labels(**labels)} {self.count}')
+        return lines
+
+class _RateLimitFilter(logging.Filter):
+    """Counts the 429s discord.py retries internally, which it only logs.
+
+    A filter rather than a handler, so the records are still handled as
+    before; a handler on the logger would keep them from reaching
+    :data:`logging.lastResort`.
+    """
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def filter(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith('We are being rate limited'):
+            # The bucket is '<channel_id>:<guild_id>:<path template>'.
+            bucket = str(record.args[1])
+            self.metrics.rate_limited[bucket.split(':', 2)[-1]] += 1
+        return True
+
+class Metrics:
+    """Command and REST metrics of a single bot.
+
+    Commands are timed by :meth:`groupbot.GroupBotMixin.invoke` and REST calls
+    by wrapping the bot's ``http.request``. The totals can be served in the
+    Prometheus text format with :meth:`start` and :meth:`render`.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.started = time.time()
+        self.commands = collections.Counter()
+        self.command_seconds = collections.defaultdict(Histogram)
+        self.command_errors = collections.Counter()
+        self.rest_requests = collections.Counter()
+        self.rest_seconds = collections.defaultdict(Histogram)
+        self.rate_limited = collections.Counter()
+        self.loop_lag = Histogram()
+        self.slow_steps = collections.Counter()
+        self.port = None
+        self.host = '127.0.0.1'
+        self.path = None
+        self.interval = 15
+        self._runner = None
+        self._writer = None
+        self._install()
+
+    def _install(self):
+        http = self.bot.http
+        request = http.request
+        async def timed_request(route, **kwargs):
+            start = time.perf_counter()
+            status = 'ok'
+            try:
+                return await request(route, **kwargs)
+            except Exception as e:
+                status = str(getattr(e, 'status', type(e).__name__))
+                raise
+            finally:
+                self.observe_request(route, status, time.perf_counter() - start)
+        http.request = timed_request
+        self._log_filter = _RateLimitFilter(self)
+        logging.getLogger('discord.http').addFilter(self._log_filter)
+        self.bot.add_listener(self.on_command_error)
+
+    def observe_command(self, ctx, elapsed):
+        name = ctx.command.qualified_name
+        self.commands[(name, 'error' if ctx.command_failed else 'ok')] += 1
+        self.command_seconds[name].observe(elapsed)
+
+    def observe_request(self, route, status, elapsed):
+        self.rest_requests[(route.method, route.path, status)] += 1
+        self.rest_seconds[(route.method, route.path)].observe(elapsed)
+
+    async def on_command_error(self, ctx, error):
+        if ctx.command is None:
+            return
+        error = getattr(error, 'original', error)
+        self.command_errors[(ctx.command.qualified_name, type(error).__name__)] += 1
+
+    def configure(self, port=None, path=None, interval=None, host=None):
+        """Sets where :meth:`start` exports to: an HTTP ``port``, a file ``path`` or both."""
+        self.port = port
+        self.path = path
+        if interval is not None:
+            self.interval = interval
+        if host is not None:
+            self.host = host
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        lines = []
+        def family(name, kind, doc):
+            lines.append(f'# HELP {name} {doc}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        family('groupbot_commands_total', 'counter', 'Commands invoked, by outcome.')
+        for (command, status), count in sorted(self.commands.items()):
+            lines.append(f'groupbot_commands_total{_labels(command=command, status=status)} {count}')
+        family('groupbot_command_seconds', 'histogram', 'Time from invocation to completion of a command.')
+        for command, h in sorted(self.command_seconds.items()):
+            lines.extend(h.render('groupbot_command_seconds', command=command))
+        family('groupbot_command_errors_total', 'counter', 'Command errors, by exception type.')
+        for (command, error), count in sorted(self.command_errors.items()):
+            lines.append(f'groupbot_command_errors_total{_labels(command=command, error=error)} {count}')
+
+        family('groupbot_rest_requests_total', 'counter', 'Discord REST requests, by route and status.')
+        for (method, route, status), count in sorted(self.rest_requests.items()):
+            lines.append(f'groupbot_rest_requests_total{_labels(method=method, route=route, status=status)} {count}')
+        family('groupbot_rest_seconds', 'histogram', 'Time spent in Discord REST requests, including rate limit waits.')
+        for (method, route), h in sorted(self.rest_seconds.items()):
+            lines.extend(h.render('groupbot_rest_seconds', method=method, route=route))
+        family('groupbot_rest_rate_limited_total', 'counter', '429 responses retried by discord.py, by route.')
+        for route, count in sorted(self.rate_limited.items()):
+            lines.append(f'groupbot_rest_rate_limited_total{_labels(route=route)} {count}')
+
+        family('groupbot_loop_lag_seconds', 'histogram', 'How late the event loop ran a periodic timer.')
+        lines.extend(self.loop_lag.render('groupbot_loop_lag_seconds'))
+        family('groupbot_slow_steps_total', 'counter', 'Event loop stalls above the threshold, by command or listener.')
+        for label, count in sorted(self.slow_steps.items()):
+            lines.append(f'groupbot_slow_steps_total{_labels(source=label)} {count}')
+
+        limiter = getattr(self.bot, 'limiter', None)
+        if limiter is not None:
+            family('groupbot_commands_queued', 'gauge', 'Commands waiting for their per-guild budget or concurrency slot.')
+            for command, count in sorted(limiter.queued().items()):
+                lines.append(f'groupbot_commands_queued{_labels(command=command)} {count}')
+
+        family('groupbot_groups', 'gauge', 'Groups in the registry.')
+        lines.append(f'groupbot_groups {len(get_registry(self.bot))}')
+        family('groupbot_guilds', 'gauge', 'Guilds the bot is in.')
+        lines.append(f'groupbot_guilds {len(self.bot.guilds)}')
+        family('groupbot_start_time_seconds', 'gauge', 'Unix time the bot started.')
+        lines.append(f'groupbot_start_time_seconds {self.started}')
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+    def write(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+
+    async def _write_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as e:
+                print(f'Could not write metrics to {self.path}: {e}')
+
+    async def start(self):
+        """Starts the configured exporters, if any."""
+        if self.port is not None and self._runner is None:
+            app = web.Application()
+            app.router.add_get('/metrics', self._handle)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            print(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+        if self.path is not None and self._writer is None:
+            self._writer = asyncio.ensure_future(self._write_periodically())
+
+    async def stop(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+            try:
+                self.write()
+            except OSError:
+                pass
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+def get_metrics(bot):
+    """Returns the metrics attached to ``bot``, creating them if needed."""
+    metrics = getattr(bot, 'metrics', None)
+    if metrics is None:
+        metrics = bot.metrics = Metrics(bot)
+    return metrics
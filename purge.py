@@ -0,0 +1,128 @@
+import asyncio
+import datetime
+import time
+
+import discord
+
+__all__ = ['ChannelPurge', 'BULK_DELETE_AGE']
+
+# Discord refuses to bulk delete messages older than 14 days. The margin covers
+# messages that age past the limit while a batch is being collected.
+BULK_DELETE_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+
+class ChannelPurge:
+    """Deletes every message of a channel posted before a given message.
+
+    History is walked newest first, so all messages young enough to be bulk
+    deleted come before the old ones. Young messages are deleted in batches of
+    100 with one request each; old ones go through a single lane that deletes
+    one message at a time, at most once every ``delay`` seconds. Discord
+    limits deleting old messages more strictly than its headers say, so the
+    lane paces itself instead of running into 429s.
+
+    With a :class:`store.GroupStore` the position is saved after every batch
+    and every ``checkpoint_every`` old messages, and a later purge of the same
+    channel picks up from there.
+    """
+    def __init__(self, channel, store=None, batch=100, delay=1.0, checkpoint_every=20):
+        self.channel = channel
+        self.store = store
+        self.batch = batch
+        self.delay = delay
+        self.checkpoint_every = checkpoint_every
+        self.before_id = None
+        self.cursor_id = None
+        self.deleted = 0
+        self.old = 0
+        self.failed = []
+        checkpoint = store.get_purge(channel.id) if store is not None else None
+        if checkpoint is not None:
+            self.before_id, self.cursor_id, self.deleted = checkpoint
+
+    @property
+    def resumed(self):
+        return self.before_id is not None
+
+    def restart(self):
+        """Forgets an unfinished purge of the channel."""
+        self.before_id = self.cursor_id = None
+        self.deleted = 0
+        if self.store is not None:
+            self.store.delete_purge(self.channel.id)
+
+    def _checkpoint(self, cursor_id):
+        self.cursor_id = cursor_id
+        if self.store is not None:
+            self.store.save_purge(self.channel.id, self.before_id, cursor_id, self.deleted)
+
+    async def run(self, before, progress=None, interval=2):
+        """Deletes the messages before ``before``, or before where the unfinished purge started.
+
+        ``progress`` is awaited with the purge at most once every ``interval``
+        seconds.
+        """
+        if self.before_id is None:
+            self.before_id = before.id
+            self._checkpoint(None)
+        last = time.monotonic()
+
+        async def report():
+            nonlocal last
+            if progress is not None and time.monotonic() - last >= interval:
+                last = time.monotonic()
+                await progress(self)
+
+        start = discord.Object(id=self.cursor_id or self.before_id)
+        batch = []
+        old = []
+        async for message in self.channel.history(limit=None, before=start):
+            if old or datetime.datetime.utcnow() - message.created_at > BULK_DELETE_AGE:
+                # Everything after the first old message is older still.
+                old.append(message)
+                if batch:
+                    await self._delete_batch(batch)
+                    batch = []
+                if len(old) >= self.checkpoint_every:
+                    await self._delete_old(old)
+                    old = []
+                    await report()
+                continue
+            batch.append(message)
+            if len(batch) >= self.batch:
+                await self._delete_batch(batch)
+                batch = []
+                await report()
+        if batch:
+            await self._delete_batch(batch)
+        if old:
+            await self._delete_old(old)
+        if self.store is not None:
+            self.store.delete_purge(self.channel.id)
+
+    async def _delete_batch(self, messages):
+        try:
+            await self.channel.delete_messages(messages)
+            self.deleted += len(messages)
+        except discord.HTTPException as e:
+            if e.status not in (400, 404):
+                self.failed.append((messages[-1].id, e))
+            else:
+                # One message that is already gone or just turned too old
+                # fails the whole batch, so fall back to deleting one by one.
+                return await self._delete_old(messages, count_old=False)
+        self._checkpoint(messages[-1].id)
+
+    async def _delete_old(self, messages, count_old=True):
+        for message in messages:
+            try:
+                await message.delete()
+                self.deleted += 1
+                if count_old:
+                    self.old += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as e:
+                self.failed.append((message.id, e))
+            if self.delay and count_old:
+                await asyncio.sleep(self.delay)
+        self._checkpoint(messages[-1].id)
@@ -0,0 +1,310 @@
+import asyncio
+import functools
+import os
+
+import discord
+
+from cogfactory import get_group_cog
+from locks import get_group_locks
+from registry import get_registry
+from rest import DEFAULT_LIMIT, gather_limited
+
+__all__ = ['ReconcilePlan', 'Reconciler', 'get_reconciler', 'group_overwrites', 'overwrite_bits', 'wrong_overwrites']
+
+def group_overwrites(guild, member_role, gm_role):
+    """The permission overwrites of a group's category."""
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite(
+            view_channel=False,
+            send_messages=False,
+            send_tts_messages=False,
+            connect=False,
+            speak=False
+        )
+    }
+    if member_role is not None:
+        overwrites[member_role] = discord.PermissionOverwrite(
+            view_channel=True,
+            send_messages=True,
+            send_tts_messages=True,
+            connect=True,
+            speak=True
+        )
+    if gm_role is not None:
+        overwrites[gm_role] = discord.PermissionOverwrite(
+            #create_instant_invite=True,
+            view_channel=True,
+            send_messages=True,
+            send_tts_messages=True,
+            connect=True,
+            speak=True,
+            manage_channels=True,
+            manage_permissions=True,
+            move_members=True,
+            mute_members=True,
+            deafen_members=True,
+            stream=True,
+            priority_speaker=True
+        )
+    return overwrites
+
+def overwrite_bits(overwrites):
+    """Returns the raw ``(allow, deny)`` bits of each overwrite, for :func:`wrong_overwrites`."""
+    bits = {}
+    for target, overwrite in overwrites.items():
+        allow, deny = overwrite.pair()
+        bits[target] = (allow.value, deny.value)
+    return bits
+
+def wrong_overwrites(channel, desired, bits):
+    """Returns the overwrites among ``desired`` that ``channel`` does not have."""
+    # Compares raw bits, overwrites_for builds a PermissionOverwrite
+    # attribute by attribute.
+    current = {o.id: (o.allow, o.deny) for o in channel._overwrites}
+    return {t: o for t, o in desired.items() if current.get(t.id, (0, 0)) != bits[t]}
+
+class ReconcilePlan:
+    """The changes that bring a guild's groups back to their desired state.
+
+    Changes are grouped into phases that run in order, each phase with
+    bounded parallelism: missing roles are created first so later phases
+    can refer to them, then names and overwrites are fixed, then vanished
+    groups are forgotten and their roles deleted.
+
+    Changes to a group are applied holding the group's lock, and skipped if
+    the group was renamed, removed or started being deleted since it was
+    planned.
+    """
+    PHASES = ('create', 'update', 'delete')
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.actions = {phase: [] for phase in self.PHASES}
+        self.created = {}
+        self.done = 0
+        self.failed = []
+
+    def __len__(self):
+        return sum(len(a) for a in self.actions.values())
+
+    def add(self, phase, description, action, entry=None):
+        """Adds ``action``, a change to the group ``entry`` if given."""
+        self.actions[phase].append((description, action, entry, entry and entry.name))
+
+    def describe(self):
+        """Returns the plan as a list of lines, empty if there is nothing to do."""
+        lines = []
+        for phase in self.PHASES:
+            lines.extend(d for d, *_ in self.actions[phase])
+        return lines
+
+    async def run(self, registry, locks, deleting, limit=DEFAULT_LIMIT):
+        """Applies the plan.
+
+        ``locks`` are the group locks from :func:`locks.get_group_locks` and
+        ``deleting`` tells whether a group id is being deleted.
+        """
+        async def apply(description, action, entry, name):
+            try:
+                if entry is None:
+                    await action()
+                else:
+                    async with locks.lock(entry.group_id):
+                        if registry.get(entry.group_id) is not entry or entry.name != name or deleting(entry.group_id):
+                            return
+                        await action()
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as e:
+                self.failed.append((description, e))
+            self.done += 1
+
+        for phase in self.PHASES:
+            await gather_limited(*(apply(*a) for a in self.actions[phase]), limit=limit)
+
+class Reconciler:
+    """Diffs the registered groups against the guild cache and repairs the difference.
+
+    For every group it makes sure that:
+
+    * both roles exist, recreating them if needed, and carry the group's name,
+    * the category grants the default role, member role and GM role their
+      group permissions,
+    * a group whose category is gone is forgotten and its roles deleted,
+    * a stray channel, one outside every group's category whose overwrites
+      grant the roles of a single group, is moved back into that group.
+
+    Channels whose permissions are still synced with the category get the
+    same fixes as the category. Channels a GM has customized are left alone,
+    as are overwrites for anyone but those three roles.
+
+    With ``prune`` it also deletes ``<name> Member`` and ``<name> GM`` roles
+    that belong to no group and that nobody holds.
+    """
+    def __init__(self, bot, interval=900, prune=False, limit=DEFAULT_LIMIT):
+        self.bot = bot
+        self.interval = interval
+        self.prune = prune
+        self.limit = limit
+        self._locks = {}
+        self._task = None
+
+    def plan(self, guild):
+        registry = get_registry(self.bot)
+        plan = ReconcilePlan(guild)
+        if guild.unavailable:
+            # Its cache is empty, every group would look vanished.
+            return plan
+        deleting = get_group_cog(self.bot).is_deleting
+        for entry in registry.entries(guild.id):
+            if deleting(entry.group_id):
+                continue
+            category = guild.get_channel(entry.group_id)
+            if category is None:
+                roles = [r for r in (guild.get_role(entry.member_role_id), guild.get_role(entry.gm_role_id)) if r is not None]
+                description = f'Forget group {entry.name} ({entry.group_id}), its category is gone'
+                if roles:
+                    description += ', and delete ' + ', '.join(f'@{r.name}' for r in roles)
+                plan.add('delete', description, self._forget(entry, roles), entry)
+                continue
+            member_role = self._plan_role(plan, entry, 'member_role_id', entry.member_role_name, discord.Color.default())
+            gm_role = self._plan_role(plan, entry, 'gm_role_id', entry.gm_role_name, discord.Color.dark_purple())
+            if member_role is None or gm_role is None:
+                # Overwrites are fixed once the missing role exists.
+                plan.add('update', f'Reset permissions of {category.name}', self._reset_permissions(plan, entry, category), entry)
+                continue
+            desired = group_overwrites(guild, member_role, gm_role)
+            bits = overwrite_bits(desired)
+            wrong = wrong_overwrites(category, desired, bits)
+            if wrong:
+                # Only looked at when the category is wrong, since it scans the guild's channels.
+                synced = [c for c in category.channels if c.permissions_synced]
+                names = ', '.join(getattr(t, 'name', str(t)) for t in wrong)
+                description = f'Fix permissions of {category.name} for {names}'
+                if synced:
+                    description += f' and {len(synced)} synced channels'
+                plan.add('update', description, self._reset_permissions(plan, entry, category), entry)
+        self._plan_strays(plan)
+        if self.prune:
+            for role in guild.roles:
+                if role.managed or role.is_default() or registry.get_by_role(role.id) is not None:
+                    continue
+                if (role.name.endswith(' Member') or role.name.endswith(' GM')) and not role.members:
+                    plan.add('delete', f'Delete orphaned role @{role.name}', role.delete)
+        return plan
+
+    def _plan_strays(self, plan):
+        """Moves channels that grant one group's roles but sit outside any group back into that group."""
+        guild = plan.guild
+        registry = get_registry(self.bot)
+        for channel in guild.channels:
+            if isinstance(channel, discord.CategoryChannel) or registry.get(channel.category_id) is not None:
+                continue
+            owners = {registry.get_by_role(o.id) for o in channel._overwrites if o.type == 'role'}
+            owners.discard(None)
+            if len(owners) != 1:
+                continue
+            entry = owners.pop()
+            category = guild.get_channel(entry.group_id)
+            if category is None:
+                continue
+            plan.add(
+                'update',
+                f'Move stray channel #{channel.name} back into {category.name}',
+                functools.partial(channel.edit, category=category, reason='Moved stray group channel back.'),
+                entry
+            )
+
+    def _plan_role(self, plan, entry, attr, name, color):
+        guild = plan.guild
+        role = guild.get_role(getattr(entry, attr)) if getattr(entry, attr) is not None else None
+        if role is None:
+            async def create():
+                role = await guild.create_role(name=name, color=color, reason=f'Recreated role of group {entry.name}.')
+                # The cache only learns of the role from the gateway, which can be later.
+                plan.created[role.id] = role
+                get_registry(self.bot).set_role(entry, **{attr: role.id})
+            plan.add('create', f'Create missing role @{name}', create, entry)
+        elif role.name != name:
+            plan.add('update', f'Rename @{role.name} to @{name}', lambda: role.edit(name=name, reason='Group name changed.'), entry)
+        return role
+
+    def _forget(self, entry, roles):
+        async def apply():
+            # Forgotten first so deleting its roles is not routed back to it.
+            get_registry(self.bot).remove(entry)
+            for role in roles:
+                try:
+                    await role.delete(reason=f'Group {entry.name} is gone.')
+                except discord.NotFound:
+                    pass
+        return apply
+
+    def _set_permissions(self, channels, overwrites):
+        async def apply():
+            # One target at a time, as CategoryChannel.edit ignores overwrites.
+            # Overwrites of anyone else are kept.
+            for channel in channels:
+                for target, overwrite in overwrites.items():
+                    await channel.set_permissions(target, overwrite=overwrite, reason='Reconciled group permissions.')
+        return apply
+
+    def _reset_permissions(self, plan, entry, category):
+        async def apply():
+            guild = category.guild
+            def role(role_id):
+                return plan.created.get(role_id) or guild.get_role(role_id)
+            desired = group_overwrites(guild, role(entry.member_role_id), role(entry.gm_role_id))
+            wrong = wrong_overwrites(category, desired, overwrite_bits(desired))
+            if wrong:
+                synced = [c for c in category.channels if c.permissions_synced]
+                await self._set_permissions([category] + synced, wrong)()
+        return apply
+
+    async def run(self, guild):
+        """Plans and applies the changes for ``guild``, one run per guild at a time."""
+        lock = self._locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            plan = self.plan(guild)
+            if len(plan):
+                await plan.run(
+                    get_registry(self.bot),
+                    get_group_locks(self.bot),
+                    get_group_cog(self.bot).is_deleting,
+                    limit=self.limit
+                )
+                print(f'Reconciled {guild.name}: {plan.done} changes, {len(plan.failed)} failed')
+            return plan
+
+    async def _run_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for guild in self.bot.guilds:
+                try:
+                    await self.run(guild)
+                except Exception as e:
+                    print(f'Reconciling {guild.name} failed: {e!r}')
+
+    def start(self):
+        if self._task is None and self.interval:
+            self._task = asyncio.ensure_future(self._run_periodically())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+def get_reconciler(bot):
+    """Returns the reconciler of ``bot``, creating it if needed.
+
+    Runs every ``RECONCILE_INTERVAL`` seconds (900 by default, 0 turns the
+    periodic run off) and prunes orphaned roles if ``RECONCILE_PRUNE`` is set.
+    """
+    reconciler = getattr(bot, 'reconciler', None)
+    if reconciler is None:
+        reconciler = bot.reconciler = Reconciler(
+            bot,
+            interval=float(os.getenv('RECONCILE_INTERVAL', '900')),
+            prune=os.getenv('RECONCILE_PRUNE', '') not in ('', '0')
+        )
+    return reconciler
@@ -0,0 +1,285 @@
+import datetime
+import re
+
+from roleindex import RoleIndex
+from store import get_store
+
+__all__ = ['GroupEntry', 'GroupRegistry', 'get_registry', 'normalize_name']
+
+def normalize_name(name):
+    """Returns the command name used to invoke a group."""
+    return re.sub(
+        r'[^a-zA-Z0-9]+',
+        r'-',
+        re.sub(r'[\'"`]', '', name.lower())
+    )
+
+class GroupEntry:
+    """The ids and names that make up a single group."""
+    __slots__ = ('guild_id', 'group_id', 'member_role_id', 'gm_role_id', 'name', 'cmd')
+
+    def __init__(self, guild_id, group_id, member_role_id, gm_role_id, name):
+        self.guild_id = guild_id
+        self.group_id = group_id
+        self.member_role_id = member_role_id
+        self.gm_role_id = gm_role_id
+        self.name = name
+        self.cmd = normalize_name(name)
+
+    def _get_member_role_name(self):
+        return f'{self.name} Member'
+    member_role_name = property(_get_member_role_name)
+
+    def _get_gm_role_name(self):
+        return f'{self.name} GM'
+    gm_role_name = property(_get_gm_role_name)
+
+    def __repr__(self):
+        return f'<GroupEntry name={self.name!r} group_id={self.group_id} guild_id={self.guild_id}>'
+
+class GroupRegistry:
+    """Index of every known group.
+
+    Groups can be looked up by category id, by the id of either of their roles,
+    or by display or command name within a guild. Every lookup is a single
+    dictionary access.
+
+    If a :class:`store.GroupStore` is given every change is written through
+    to it, except :meth:`clear` which only forgets groups in memory.
+
+    The holders of each group role are kept in :attr:`members`, a
+    :class:`roleindex.RoleIndex`.
+    """
+    def __init__(self, store=None):
+        self.store = store
+        self.members = RoleIndex()
+        self._by_id = {}
+        self._by_guild = {}
+        self._by_role = {}
+        self._by_name = {}
+        self._by_cmd = {}
+        self._changes = 0
+        self._versions = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, group_id):
+        return group_id in self._by_id
+
+    def entries(self, guild_id=None):
+        if guild_id is None:
+            return list(self._by_id.values())
+        return list(self._by_guild.get(guild_id, {}).values())
+
+    def get(self, group_id):
+        return self._by_id.get(group_id)
+
+    def get_by_role(self, role_id):
+        return self._by_role.get(role_id)
+
+    def get_by_name(self, guild_id, name):
+        return self._by_name.get((guild_id, name))
+
+    def get_by_cmd(self, guild_id, cmd):
+        return self._by_cmd.get((guild_id, normalize_name(cmd)))
+
+    def version(self, guild_id):
+        """Returns a number that changes whenever a group of ``guild_id`` changes."""
+        return self._versions.get(guild_id, 0)
+
+    def _touch(self, guild_id):
+        self._changes += 1
+        self._versions[guild_id] = self._changes
+
+    def _save(self, entry):
+        self._touch(entry.guild_id)
+        if self.store is not None:
+            self.store.save_group(entry)
+
+    def add(self, entry, save=True):
+        if entry.group_id in self._by_id:
+            self._forget(self._by_id[entry.group_id])
+        self._by_id[entry.group_id] = entry
+        self._by_guild.setdefault(entry.guild_id, {})[entry.group_id] = entry
+        self._by_name[(entry.guild_id, entry.name)] = entry
+        self._by_cmd[(entry.guild_id, entry.cmd)] = entry
+        for role_id in (entry.member_role_id, entry.gm_role_id):
+            if role_id is not None:
+                self._by_role[role_id] = entry
+        if save:
+            self._save(entry)
+        else:
+            self._touch(entry.guild_id)
+        return entry
+
+    def remove(self, entry):
+        self._forget(entry)
+        if self.store is not None:
+            self.store.delete_group(entry.group_id)
+
+    def _forget(self, entry):
+        self._touch(entry.guild_id)
+        self._by_id.pop(entry.group_id, None)
+        guild_entries = self._by_guild.get(entry.guild_id)
+        if guild_entries is not None:
+            guild_entries.pop(entry.group_id, None)
+            if not guild_entries:
+                del self._by_guild[entry.guild_id]
+        if self._by_name.get((entry.guild_id, entry.name)) is entry:
+            del self._by_name[(entry.guild_id, entry.name)]
+        if self._by_cmd.get((entry.guild_id, entry.cmd)) is entry:
+            del self._by_cmd[(entry.guild_id, entry.cmd)]
+        for role_id in (entry.member_role_id, entry.gm_role_id):
+            if self._by_role.get(role_id) is entry:
+                del self._by_role[role_id]
+                self.members.drop(role_id)
+
+    def rename(self, entry, name):
+        """Moves ``entry`` to ``name`` and its command name, without yielding to the event loop."""
+        cmd = normalize_name(name)
+        if self._by_name.get((entry.guild_id, entry.name)) is entry:
+            del self._by_name[(entry.guild_id, entry.name)]
+        if self._by_cmd.get((entry.guild_id, entry.cmd)) is entry:
+            del self._by_cmd[(entry.guild_id, entry.cmd)]
+        entry.name = name
+        entry.cmd = cmd
+        self._by_name[(entry.guild_id, entry.name)] = entry
+        self._by_cmd[(entry.guild_id, entry.cmd)] = entry
+        self._save(entry)
+
+    def set_role(self, entry, *, member_role_id=..., gm_role_id=...):
+        """Updates the role ids of a group, ``None`` marks a role as missing."""
+        if member_role_id is not ...:
+            if self._by_role.get(entry.member_role_id) is entry:
+                del self._by_role[entry.member_role_id]
+                self.members.drop(entry.member_role_id)
+            entry.member_role_id = member_role_id
+            if member_role_id is not None:
+                self._by_role[member_role_id] = entry
+        if gm_role_id is not ...:
+            if self._by_role.get(entry.gm_role_id) is entry:
+                del self._by_role[entry.gm_role_id]
+                self.members.drop(entry.gm_role_id)
+            entry.gm_role_id = gm_role_id
+            if gm_role_id is not None:
+                self._by_role[gm_role_id] = entry
+        self._save(entry)
+
+    def clear(self, guild_id=None):
+        for entry in self.entries(guild_id):
+            self._forget(entry)
+
+    def load_guild(self, guild, rows):
+        """Adds the stored groups of ``guild``.
+
+        ``rows`` come from :meth:`store.GroupStore.load`. Names or roles that
+        changed while the bot was offline are corrected. Groups whose category
+        is not in the cache are added as stored; whether it is really gone is
+        left to :class:`reconcile.Reconciler`, as the cache of an unavailable
+        guild is empty.
+        """
+        entries = []
+        for guild_id, group_id, member_role_id, gm_role_id, name in rows:
+            cat = guild.get_channel(group_id)
+            entry = GroupEntry(guild_id, group_id, member_role_id, gm_role_id, name)
+            if cat is None:
+                entries.append(self.add(entry, save=False))
+                continue
+            changed = cat.name != name
+            entry.name = cat.name
+            entry.cmd = normalize_name(cat.name)
+            if member_role_id is not None and guild.get_role(member_role_id) is None:
+                entry.member_role_id = None
+                changed = True
+            if gm_role_id is not None and guild.get_role(gm_role_id) is None:
+                entry.gm_role_id = None
+                changed = True
+            entries.append(self.add(entry, save=changed))
+        return entries
+
+    def save_members(self, guild):
+        """Records the holders of every group role in ``guild`` in one pass over its members.
+
+        Holders are ordered by how long they have held the role as far as the
+        store knows, then by when they joined the guild.
+        """
+        holders = {}
+        for entry in self.entries(guild.id):
+            for role_id in (entry.member_role_id, entry.gm_role_id):
+                if role_id is not None:
+                    holders[role_id] = []
+        for m in guild.members:
+            for r in m.roles:
+                if r.id in holders:
+                    holders[r.id].append(m)
+        for role_id, members in holders.items():
+            members.sort(key=lambda m: (m.joined_at or datetime.datetime.max, m.id))
+            user_ids = [m.id for m in members]
+            if self.store is not None:
+                self.store.set_members(self._by_role[role_id].group_id, role_id, user_ids)
+                user_ids = self.store.members(role_id)
+            self.members.set(role_id, user_ids)
+
+    def member_added(self, role_id, user_id):
+        """Records that ``user_id`` was given a group role, returns the group or ``None``."""
+        entry = self.get_by_role(role_id)
+        if entry is not None:
+            self.members.add(role_id, user_id)
+            if self.store is not None:
+                self.store.add_member(entry.group_id, role_id, user_id)
+        return entry
+
+    def member_removed(self, role_id, user_id):
+        """Records that ``user_id`` lost a group role, returns the group or ``None``."""
+        entry = self.get_by_role(role_id)
+        if entry is not None:
+            self.members.remove(role_id, user_id)
+            if self.store is not None:
+                self.store.remove_member(role_id, user_id)
+        return entry
+
+    def index_guild(self, guild):
+        """Indexes every category in ``guild`` that has both group roles.
+
+        Roles are scanned once, so this is linear in the number of roles and
+        categories rather than their product.
+        """
+        roles = {r.name: r for r in guild.roles}
+        entries = []
+        for c in guild.categories:
+            member_role = roles.get(f'{c.name} Member')
+            gm_role = roles.get(f'{c.name} GM')
+            if member_role is None or gm_role is None:
+                continue
+            entries.append(self.add(GroupEntry(guild.id, c.id, member_role.id, gm_role.id, c.name)))
+        return entries
+
+    def role_created(self, role):
+        """Reattaches a recreated ``<name> Member`` or ``<name> GM`` role."""
+        for suffix, attr in ((' Member', 'member_role_id'), (' GM', 'gm_role_id')):
+            if role.name.endswith(suffix):
+                entry = self.get_by_name(role.guild.id, role.name[:-len(suffix)])
+                if entry is not None and getattr(entry, attr) is None:
+                    self.set_role(entry, **{attr: role.id})
+                return entry
+
+    def role_deleted(self, role):
+        entry = self.get_by_role(role.id)
+        if entry is None:
+            return None
+        if entry.member_role_id == role.id:
+            self.set_role(entry, member_role_id=None)
+        if entry.gm_role_id == role.id:
+            self.set_role(entry, gm_role_id=None)
+        return entry
+
+def get_registry(bot):
+    """Returns the group registry attached to ``bot``, creating it if needed."""
+    registry = getattr(bot, 'group_registry', None)
+    if registry is None:
+        registry = bot.group_registry = GroupRegistry(get_store(bot))
+    return registry
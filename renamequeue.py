@@ -0,0 +1,107 @@
+import asyncio
+
+import discord
+
+from locks import get_group_locks
+from registry import get_registry
+from rest import DEFAULT_LIMIT, gather_limited
+
+__all__ = ['RenameQueue', 'get_rename_queue']
+
+class _PendingRename:
+    __slots__ = ('entry', 'name', 'handle')
+
+    def __init__(self, entry, name):
+        self.entry = entry
+        self.name = name
+        self.handle = None
+
+class RenameQueue:
+    """Applies group renames once a group's name has stopped changing.
+
+    Every rename of a group restarts its ``window`` second timer, so a
+    category renamed several times in a row is only applied once, with its
+    final name: the registry swaps the group's command name in one step and
+    both roles are renamed concurrently. Renames of the same group are applied
+    in order, holding the group's lock from :func:`locks.get_group_locks`.
+    """
+    def __init__(self, bot, window=2.0, limit=DEFAULT_LIMIT):
+        self.bot = bot
+        self.window = window
+        self.limit = limit
+        self._pending = {}
+        self._applying = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def rename(self, entry, name):
+        pending = self._pending.get(entry.group_id)
+        if pending is None:
+            pending = self._pending[entry.group_id] = _PendingRename(entry, name)
+        else:
+            pending.handle.cancel()
+            pending.name = name
+        pending.handle = asyncio.get_event_loop().call_later(self.window, self._schedule, entry.group_id)
+
+    def cancel(self, entry):
+        """Drops a pending rename, e.g. because the group is being deleted."""
+        pending = self._pending.pop(entry.group_id, None)
+        if pending is not None:
+            pending.handle.cancel()
+
+    def _schedule(self, group_id):
+        pending = self._pending.pop(group_id)
+        previous = self._applying.get(group_id)
+        task = self._applying[group_id] = asyncio.ensure_future(self._apply(pending, previous))
+        def done(t):
+            if self._applying.get(group_id) is t:
+                del self._applying[group_id]
+        task.add_done_callback(done)
+
+    async def _apply(self, pending, previous=None):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        async with get_group_locks(self.bot).lock(pending.entry.group_id):
+            await self._rename(pending)
+
+    async def _rename(self, pending):
+        entry = pending.entry
+        registry = get_registry(self.bot)
+        if registry.get(entry.group_id) is not entry or pending.name == entry.name:
+            return
+        registry.rename(entry, pending.name)
+        guild = self.bot.get_guild(entry.guild_id)
+        roles = []
+        if guild is not None:
+            roles = [
+                (guild.get_role(entry.member_role_id), entry.member_role_name),
+                (guild.get_role(entry.gm_role_id), entry.gm_role_name)
+            ]
+        results = await asyncio.gather(
+            *(role.edit(name=name, reason='Group name updated.') for role, name in roles if role is not None),
+            return_exceptions=True
+        )
+        for e in results:
+            if isinstance(e, discord.HTTPException):
+                print(f'Could not rename a role of {entry.name}: {e}')
+            elif isinstance(e, BaseException):
+                raise e
+        print(f'Group name updated to {entry.cmd}')
+
+    async def flush(self):
+        """Applies every pending rename now, e.g. before shutting down."""
+        renames = list(self._pending.values())
+        self._pending.clear()
+        for pending in renames:
+            pending.handle.cancel()
+        await gather_limited(*(self._apply(p, self._applying.get(p.entry.group_id)) for p in renames), limit=self.limit)
+        if self._applying:
+            await asyncio.gather(*self._applying.values(), return_exceptions=True)
+
+def get_rename_queue(bot):
+    """Returns the rename queue attached to ``bot``, creating it if needed."""
+    queue = getattr(bot, 'rename_queue', None)
+    if queue is None:
+        queue = bot.rename_queue = RenameQueue(bot)
+    return queue
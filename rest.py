@@ -0,0 +1,25 @@
+import asyncio
+
+__all__ = ['gather_limited', 'DEFAULT_LIMIT']
+
+# Discord allows 50 requests a second across all routes. Staying well below
+# that leaves room for the rest of the bot while a fan-out is running.
+DEFAULT_LIMIT = 8
+
+async def gather_limited(*aws, limit=DEFAULT_LIMIT, return_exceptions=False):
+    """Awaits ``aws`` concurrently with at most ``limit`` of them in flight.
+
+    Results are returned in the order given, like :func:`asyncio.gather`.
+    discord.py already queues requests that share a rate limit bucket, so the
+    limit only caps how many requests are outstanding across buckets.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(
+        *(run(aw) for aw in aws),
+        return_exceptions=return_exceptions
+    )
@@ -0,0 +1,51 @@
+import collections
+
+__all__ = ['RoleIndex']
+
+class RoleIndex:
+    """The holders of every group role, longest held first.
+
+    Kept up to date from member updates, so counting a role's holders or
+    finding the longest held member who is not a GM does not have to scan the
+    guild's members like ``Role.members`` does.
+    """
+    def __init__(self):
+        self._holders = {}
+
+    def set(self, role_id, user_ids):
+        """Replaces the holders of ``role_id``, given longest held first."""
+        self._holders[role_id] = collections.OrderedDict.fromkeys(user_ids)
+
+    def add(self, role_id, user_id):
+        holders = self._holders.setdefault(role_id, collections.OrderedDict())
+        if user_id not in holders:
+            holders[user_id] = None
+
+    def remove(self, role_id, user_id):
+        holders = self._holders.get(role_id)
+        if holders is not None:
+            holders.pop(user_id, None)
+
+    def drop(self, role_id):
+        self._holders.pop(role_id, None)
+
+    def holds(self, role_id, user_id):
+        return user_id in self._holders.get(role_id, ())
+
+    def count(self, role_id):
+        return len(self._holders.get(role_id, ()))
+
+    def holders(self, role_id):
+        return list(self._holders.get(role_id, ()))
+
+    def successor(self, entry, exclude=()):
+        """Returns the id of the longest held member of ``entry`` who is not a GM, or ``None``.
+
+        Only GMs and ``exclude`` are skipped, so this looks at a handful of
+        members at most.
+        """
+        gms = self._holders.get(entry.gm_role_id, ())
+        for user_id in self._holders.get(entry.member_role_id, ()):
+            if user_id not in gms and user_id not in exclude:
+                return user_id
+        return None
@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+import discord
+
+from rest import DEFAULT_LIMIT
+
+__all__ = ['RoleQueue', 'get_role_queue']
+
+class _PendingEdit:
+    __slots__ = ('member', 'add', 'remove', 'reasons', 'futures', 'handle')
+
+    def __init__(self, member):
+        self.member = member
+        self.add = set()
+        self.remove = set()
+        self.reasons = []
+        self.futures = []
+        self.handle = None
+
+class RoleQueue:
+    """Coalesces role changes to the same member into one ``member.edit``.
+
+    Changes queued within ``window`` seconds of the first pending change for a
+    member are applied together with a single request. When a role is both
+    added and removed within the window the last change wins. The returned
+    futures resolve once the edit has been sent, or raise what it raised.
+
+    ``member.edit`` replaces the member's whole role list, so edits to one
+    member are sent one at a time, and the roles sent are used instead of the
+    cached ones until the gateway confirms them with :meth:`member_updated`,
+    or ``confirm_timeout`` seconds have passed. Otherwise an edit computed
+    before the previous one's update arrived would put the old roles back.
+    """
+    def __init__(self, window=0.5, limit=DEFAULT_LIMIT, confirm_timeout=30.0):
+        self.window = window
+        self.limit = limit
+        self.confirm_timeout = confirm_timeout
+        self._pending = {}
+        self._applying = {}
+        self._sent = {}
+        self._flushing = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _queue(self, member, add, remove, reason):
+        loop = asyncio.get_event_loop()
+        key = (member.guild.id, member.id)
+        edit = self._pending.get(key)
+        if edit is None:
+            edit = self._pending[key] = _PendingEdit(member)
+            edit.handle = loop.call_later(self.window, self._schedule, key)
+        edit.member = member
+        for r in add:
+            edit.remove.discard(r.id)
+            edit.add.add(r.id)
+        for r in remove:
+            edit.add.discard(r.id)
+            edit.remove.add(r.id)
+        if reason and reason not in edit.reasons:
+            edit.reasons.append(reason)
+        future = loop.create_future()
+        edit.futures.append(future)
+        return future
+
+    def add_roles(self, member, *roles, reason=None):
+        return self._queue(member, [r for r in roles if r is not None], (), reason)
+
+    def remove_roles(self, member, *roles, reason=None):
+        return self._queue(member, (), [r for r in roles if r is not None], reason)
+
+    def _schedule(self, key):
+        self._start(key, self._pending.pop(key))
+
+    def _start(self, key, edit, semaphore=None):
+        previous = self._applying.get(key)
+        task = self._applying[key] = asyncio.ensure_future(self._apply(key, edit, previous, semaphore))
+        self._flushing.add(task)
+        def done(t):
+            self._flushing.discard(t)
+            if self._applying.get(key) is t:
+                del self._applying[key]
+        task.add_done_callback(done)
+        return task
+
+    def _current(self, key, member):
+        """The member's roles: the last ones sent if the gateway has not confirmed them yet."""
+        sent = self._sent.get(key)
+        if sent is not None:
+            roles, when = sent
+            if time.monotonic() - when < self.confirm_timeout:
+                return set(roles)
+            del self._sent[key]
+        return {r.id for r in member.roles if r != member.guild.default_role}
+
+    def member_updated(self, member):
+        """Forgets the roles sent for ``member`` once its cached roles match them."""
+        key = (member.guild.id, member.id)
+        sent = self._sent.get(key)
+        if sent is not None and sent[0] == {r.id for r in member.roles if r != member.guild.default_role}:
+            del self._sent[key]
+
+    async def _apply(self, key, edit, previous=None, semaphore=None):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        if semaphore is None:
+            await self._edit(key, edit)
+        else:
+            async with semaphore:
+                await self._edit(key, edit)
+
+    async def _edit(self, key, edit):
+        member = edit.member
+        current = self._current(key, member)
+        roles = (current | edit.add) - edit.remove
+        try:
+            if roles != current:
+                await member.edit(
+                    roles=[discord.Object(id=i) for i in roles],
+                    reason='; '.join(edit.reasons)[:512] or None
+                )
+                self._sent[key] = (frozenset(roles), time.monotonic())
+        except Exception as e:
+            for f in edit.futures:
+                if not f.done():
+                    f.set_exception(e)
+        else:
+            for f in edit.futures:
+                if not f.done():
+                    f.set_result(None)
+
+    async def flush(self):
+        """Applies every pending change now, at most ``limit`` at a time, e.g. before shutting down."""
+        edits = list(self._pending.items())
+        self._pending.clear()
+        semaphore = asyncio.Semaphore(self.limit)
+        for key, edit in edits:
+            edit.handle.cancel()
+            self._start(key, edit, semaphore)
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+def get_role_queue(bot):
+    """Returns the role queue attached to ``bot``, creating it if needed."""
+    queue = getattr(bot, 'role_queue', None)
+    if queue is None:
+        queue = bot.role_queue = RoleQueue()
+    return queue
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import time
+
+__all__ = ['GroupStore', 'get_store']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS groups (
+    group_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    member_role_id INTEGER,
+    gm_role_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS group_members (
+    role_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    group_id INTEGER NOT NULL,
+    added_at REAL NOT NULL,
+    PRIMARY KEY (role_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS group_members_group ON group_members (group_id);
+CREATE TABLE IF NOT EXISTS purges (
+    channel_id INTEGER PRIMARY KEY,
+    before_id INTEGER NOT NULL,
+    cursor_id INTEGER,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS archives (
+    channel_id INTEGER PRIMARY KEY,
+    last_id INTEGER,
+    count INTEGER NOT NULL DEFAULT 0,
+    path TEXT NOT NULL
+);
+'''
+
+class GroupStore:
+    """SQLite backed copy of the group registry.
+
+    Lets startup load every known group with one query instead of re-deriving
+    groups from the guild's categories and roles. Every change is written
+    through as it happens.
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def load(self, guild_id=None):
+        """Returns ``(guild_id, group_id, member_role_id, gm_role_id, name)`` for every group."""
+        if guild_id is None:
+            return self.db.execute(
+                'SELECT guild_id, group_id, member_role_id, gm_role_id, name FROM groups'
+            ).fetchall()
+        return self.db.execute(
+            'SELECT guild_id, group_id, member_role_id, gm_role_id, name FROM groups WHERE guild_id = ?',
+            (guild_id,)
+        ).fetchall()
+
+    def save_group(self, entry):
+        self.db.execute(
+            'INSERT OR REPLACE INTO groups (group_id, guild_id, name, member_role_id, gm_role_id) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (entry.group_id, entry.guild_id, entry.name, entry.member_role_id, entry.gm_role_id)
+        )
+
+    def delete_group(self, group_id):
+        self.db.execute('DELETE FROM groups WHERE group_id = ?', (group_id,))
+        self.db.execute('DELETE FROM group_members WHERE group_id = ?', (group_id,))
+
+    def members(self, role_id):
+        """Returns the ids of users with a group role, longest held first."""
+        return [r[0] for r in self.db.execute(
+            'SELECT user_id FROM group_members WHERE role_id = ? ORDER BY added_at, rowid', (role_id,)
+        )]
+
+    def add_member(self, group_id, role_id, user_id):
+        self.db.execute(
+            'INSERT OR IGNORE INTO group_members (role_id, user_id, group_id, added_at) VALUES (?, ?, ?, ?)',
+            (role_id, user_id, group_id, time.time())
+        )
+
+    def remove_member(self, role_id, user_id):
+        self.db.execute(
+            'DELETE FROM group_members WHERE role_id = ? AND user_id = ?',
+            (role_id, user_id)
+        )
+
+    def set_members(self, group_id, role_id, user_ids):
+        """Replaces the users recorded for a role, keeping existing tenure.
+
+        New users are recorded in the order given.
+        """
+        now = time.time()
+        self.db.execute('BEGIN')
+        try:
+            self.db.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS current_members '
+                '(position INTEGER PRIMARY KEY, user_id INTEGER UNIQUE)'
+            )
+            self.db.execute('DELETE FROM current_members')
+            self.db.executemany(
+                'INSERT OR IGNORE INTO current_members (user_id) VALUES (?)',
+                ((u,) for u in user_ids)
+            )
+            self.db.execute(
+                'DELETE FROM group_members WHERE role_id = ? '
+                'AND user_id NOT IN (SELECT user_id FROM current_members)',
+                (role_id,)
+            )
+            self.db.execute(
+                'INSERT OR IGNORE INTO group_members (role_id, user_id, group_id, added_at) '
+                'SELECT ?, user_id, ?, ? FROM current_members ORDER BY position',
+                (role_id, group_id, now)
+            )
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def get_purge(self, channel_id):
+        """Returns ``(before_id, cursor_id, deleted)`` of an unfinished purge of a channel, or ``None``."""
+        return self.db.execute(
+            'SELECT before_id, cursor_id, deleted FROM purges WHERE channel_id = ?', (channel_id,)
+        ).fetchone()
+
+    def save_purge(self, channel_id, before_id, cursor_id, deleted):
+        self.db.execute(
+            'INSERT OR REPLACE INTO purges (channel_id, before_id, cursor_id, deleted) VALUES (?, ?, ?, ?)',
+            (channel_id, before_id, cursor_id, deleted)
+        )
+
+    def delete_purge(self, channel_id):
+        self.db.execute('DELETE FROM purges WHERE channel_id = ?', (channel_id,))
+
+    def get_archive(self, channel_id):
+        """Returns ``(last_id, count, path)`` of what has been archived of a channel, or ``None``."""
+        return self.db.execute(
+            'SELECT last_id, count, path FROM archives WHERE channel_id = ?', (channel_id,)
+        ).fetchone()
+
+    def save_archive(self, channel_id, last_id, count, path):
+        self.db.execute(
+            'INSERT OR REPLACE INTO archives (channel_id, last_id, count, path) VALUES (?, ?, ?, ?)',
+            (channel_id, last_id, count, path)
+        )
+
+def get_store(bot):
+    """Returns the group store attached to ``bot``, opening it if needed.
+
+    The database path is read from ``GROUP_DB`` and defaults to ``groups.db``.
+    """
+    store = getattr(bot, 'group_store', None)
+    if store is None:
+        store = bot.group_store = GroupStore(os.getenv('GROUP_DB', 'groups.db'))
+    return store
@@ -0,0 +1,92 @@
+import signal
+import subprocess
+import sys
+import time
+
+__all__ = ['Supervisor', 'partition_shards']
+
+def partition_shards(shard_count, processes):
+    """Splits ``range(shard_count)`` into ``processes`` contiguous ranges."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+class Worker:
+    def __init__(self, shard_ids, shard_count):
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started = 0
+        self.backoff = 1
+        self.restart_at = None
+
+    @property
+    def args(self):
+        return [
+            sys.executable, 'bot.py',
+            '--shard-count', str(self.shard_count),
+            '--shard-ids', ','.join(str(i) for i in self.shard_ids)
+        ]
+
+    def start(self):
+        self.process = subprocess.Popen(self.args)
+        self.started = time.monotonic()
+        self.restart_at = None
+        print(f'Started shards {self.shard_ids} as pid {self.process.pid}')
+
+class Supervisor:
+    """Runs ``bot.py`` as several worker processes, each owning a range of shards.
+
+    Workers that exit with a non-zero status are restarted with exponential
+    backoff. ``SIGINT``/``SIGTERM`` are forwarded to every worker.
+    """
+    max_backoff = 60
+
+    def __init__(self, processes, shard_count=None):
+        shard_count = shard_count or processes
+        self.workers = [Worker(ids, shard_count) for ids in partition_shards(shard_count, processes)]
+        self.stopping = False
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for w in self.workers:
+            if w.process is not None and w.process.poll() is None:
+                w.process.terminate()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for w in self.workers:
+            w.start()
+        while not self.stopping:
+            now = time.monotonic()
+            for w in self.workers:
+                if w.restart_at is not None:
+                    if now >= w.restart_at:
+                        w.start()
+                    continue
+                code = w.process.poll()
+                if code is None:
+                    continue
+                if code == 0:
+                    print(f'Shards {w.shard_ids} exited cleanly, not restarting')
+                    w.restart_at = float('inf')
+                    continue
+                # Reset the backoff for workers that stayed up for a while.
+                if now - w.started > self.max_backoff:
+                    w.backoff = 1
+                print(f'Shards {w.shard_ids} exited with {code}, restarting in {w.backoff}s', file=sys.stderr)
+                w.restart_at = now + w.backoff
+                w.backoff = min(w.backoff * 2, self.max_backoff)
+            if all(w.restart_at == float('inf') for w in self.workers):
+                break
+            time.sleep(1)
+        for w in self.workers:
+            if w.process is not None:
+                w.process.wait()
@@ -0,0 +1,118 @@
+import time
+
+import discord
+
+from rest import DEFAULT_LIMIT, gather_limited
+
+__all__ = ['TeardownPlan', 'plan_teardown']
+
+class TeardownPlan:
+    """Everything ``clear-groups`` will delete, deduplicated by id.
+
+    Text channels are archived first if an :class:`archive.Archive` is given.
+    Channels are deleted before their categories and roles last, each phase
+    with bounded parallelism.
+    """
+    def __init__(self, guild):
+        self.guild = guild
+        self.names = {}
+        self.channels = {}
+        self.categories = {}
+        self.roles = {}
+        self.entries = []
+        self.done = 0
+        self.archived = {}
+        self.failed = []
+
+    def __len__(self):
+        return len(self.channels) + len(self.categories) + len(self.roles)
+
+    def add_group(self, name, category=None, *roles):
+        self.names[name] = None
+        if category is not None and category.id not in self.categories:
+            self.categories[category.id] = category
+            for c in category.channels:
+                self.channels[c.id] = c
+        for r in roles:
+            if r is not None and r != self.guild.default_role and not r.managed:
+                self.roles[r.id] = r
+
+    @property
+    def group_names(self):
+        return list(self.names)
+
+    def describe(self):
+        """Returns the plan as a list of lines, empty if there is nothing to do."""
+        if not self.names:
+            return []
+        lines = [f'Groups ({len(self.names)}): {", ".join(self.names)}']
+        lines.append(f'Channels ({len(self.channels)}):')
+        lines.extend(f'  #{c.name} ({c.id})' for c in self.channels.values())
+        lines.append(f'Categories ({len(self.categories)}):')
+        lines.extend(f'  {c.name} ({c.id})' for c in self.categories.values())
+        lines.append(f'Roles ({len(self.roles)}):')
+        lines.extend(f'  @{r.name} ({r.id})' for r in self.roles.values())
+        return lines
+
+    async def run(self, registry=None, progress=None, limit=DEFAULT_LIMIT, interval=2, archive=None):
+        """Deletes everything in the plan.
+
+        ``progress`` is awaited with the plan at most once every ``interval``
+        seconds while deleting. Failed deletions are collected in
+        :attr:`failed` instead of aborting the teardown. Channels that could
+        not be archived are kept and listed in :attr:`failed` too.
+        """
+        # Drop the groups first so the channel delete router ignores our deletions.
+        if registry is not None:
+            for entry in self.entries:
+                registry.remove(entry)
+        if archive is not None:
+            self.archived, failed = await archive.channels(self.channels.values())
+            for c, e in failed:
+                del self.channels[c.id]
+                self.failed.append((c, e))
+            if progress is not None:
+                await progress(self)
+        last = time.monotonic()
+
+        async def delete(obj):
+            nonlocal last
+            try:
+                await obj.delete(reason='Cleared groups.')
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as e:
+                self.failed.append((obj, e))
+            self.done += 1
+            if progress is not None and time.monotonic() - last >= interval:
+                last = time.monotonic()
+                await progress(self)
+
+        for phase in (self.channels, self.categories, self.roles):
+            await gather_limited(*(delete(o) for o in phase.values()), limit=limit)
+
+def plan_teardown(guild, registry):
+    """Builds the deletion plan for every group in ``guild``.
+
+    Covers registered groups, every category and every ``Member``/``GM`` role,
+    scanning the guild's roles only once.
+    """
+    plan = TeardownPlan(guild)
+    roles = {r.name: r for r in guild.roles}
+    for entry in registry.entries(guild.id):
+        plan.entries.append(entry)
+        plan.add_group(
+            entry.name,
+            guild.get_channel(entry.group_id),
+            guild.get_role(entry.member_role_id),
+            guild.get_role(entry.gm_role_id)
+        )
+    for c in guild.categories:
+        plan.add_group(c.name, c, roles.get(f'{c.name} Member'), roles.get(f'{c.name} GM'))
+    for r in guild.roles:
+        if r.name.endswith('Member'):
+            name = r.name.replace(' Member', '')
+            plan.add_group(name, None, r, roles.get(f'{name} GM'))
+        elif r.name.endswith('GM'):
+            plan.add_group(r.name.replace(' GM', ''), None, r)
+    return plan
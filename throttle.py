@@ -0,0 +1,154 @@
+import asyncio
+import collections
+import functools
+import os
+import time
+
+from discord.ext import commands
+
+__all__ = ['CommandLimiter', 'TokenBucket', 'get_limiter', 'throttled']
+
+class TokenBucket:
+    """Hands out ``rate`` tokens a second, at most ``capacity`` at once.
+
+    Callers that need more tokens than are left wait for them in the order
+    they asked instead of being turned away.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost):
+        """Returns how long taking ``cost`` tokens would wait if nobody were ahead."""
+        self._refill()
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+    async def take(self, cost):
+        cost = min(cost, self.capacity)
+        async with self._lock:
+            self._refill()
+            if self.tokens < cost:
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= cost
+
+class _Slots:
+    __slots__ = ('semaphore', 'running', 'waiting')
+
+    def __init__(self, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.running = 0
+        self.waiting = 0
+
+class CommandLimiter:
+    """Budgets the REST-heavy commands of each guild.
+
+    Every guild has a :class:`TokenBucket` of ``rate`` tokens a second and
+    ``burst`` at most, and each throttled command takes its cost from it
+    before running. On top of that at most ``concurrency`` invocations of a
+    command run at once per guild. Invocations over either limit wait their
+    turn and the caller is told how many are ahead of them.
+    """
+    def __init__(self, rate=2.0, burst=20):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._slots = {}
+
+    def bucket(self, guild_id):
+        bucket = self._buckets.get(guild_id)
+        if bucket is None:
+            bucket = self._buckets[guild_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def queued(self):
+        """Returns the number of waiting invocations per command."""
+        queued = collections.Counter()
+        for (_, name), slots in self._slots.items():
+            queued[name] += slots.waiting
+        return queued
+
+    async def run(self, ctx, cost, concurrency, func, *args, **kwargs):
+        """Calls ``func`` for ``ctx`` once a slot and ``cost`` tokens are free.
+
+        With ``concurrency`` of ``None`` only the budget applies.
+        """
+        if ctx.guild is None:
+            return await func(*args, **kwargs)
+        name = ctx.command.qualified_name
+        bucket = self.bucket(ctx.guild.id)
+        cost = self.burst if cost is None else cost
+        if concurrency is None:
+            if bucket.wait_time(cost) >= 1:
+                await ctx.send(f'This server is running a lot of commands, `{name}` starts in about {bucket.wait_time(cost):.0f}s.')
+            await bucket.take(cost)
+            return await func(*args, **kwargs)
+        key = (ctx.guild.id, name)
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = _Slots(concurrency)
+        ahead = slots.waiting + max(0, slots.running + 1 - concurrency)
+        slots.waiting += 1
+        started = False
+        try:
+            if ahead:
+                await ctx.send(f'Queued behind {ahead} other `{name}` command{"s" if ahead > 1 else ""}.')
+            elif bucket.wait_time(cost) >= 1:
+                await ctx.send(f'This server is running a lot of commands, `{name}` starts in about {bucket.wait_time(cost):.0f}s.')
+            async with slots.semaphore:
+                slots.waiting -= 1
+                started = True
+                slots.running += 1
+                try:
+                    await bucket.take(cost)
+                    return await func(*args, **kwargs)
+                finally:
+                    slots.running -= 1
+        finally:
+            if not started:
+                slots.waiting -= 1
+            if slots.running + slots.waiting == 0:
+                self._slots.pop(key, None)
+
+def throttled(cost=1, concurrency=1):
+    """Runs a command through the bot's :class:`CommandLimiter`.
+
+    ``cost`` is roughly the number of REST requests the command makes,
+    ``None`` for the guild's whole burst, or a callable taking the command's
+    arguments that returns either. ``concurrency`` is how many invocations of
+    the command may run at once in a guild, ``None`` for no limit. Goes below
+    the command decorator, so checks and argument conversion happen before the
+    invocation waits.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            # Cog commands are called with the cog first.
+            ctx = args[1] if isinstance(args[0], commands.Cog) else args[0]
+            c = cost(*args, **kwargs) if callable(cost) else cost
+            return await get_limiter(ctx.bot).run(ctx, c, concurrency, func, *args, **kwargs)
+        wrapper.__throttle__ = (cost, concurrency)
+        return wrapper
+    return decorator
+
+def get_limiter(bot):
+    """Returns the command limiter of ``bot``, creating it if needed.
+
+    Each guild gets ``COMMAND_RATE`` tokens a second (2 by default) and at
+    most ``COMMAND_BURST`` (20 by default).
+    """
+    limiter = getattr(bot, 'limiter', None)
+    if limiter is None:
+        limiter = bot.limiter = CommandLimiter(
+            rate=float(os.getenv('COMMAND_RATE', '2')),
+            burst=float(os.getenv('COMMAND_BURST', '20'))
+        )
+    return limiter
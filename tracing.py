@@ -0,0 +1,216 @@
+import contextvars
+import json
+import random
+import time
+
+__all__ = ['Span', 'Tracer', 'get_tracer']
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """A timed operation, the child of whatever span was current when it started.
+
+    Spans of a trace that was not sampled are still created, so their children
+    know not to record themselves, but are never written.
+    """
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'sampled',
+                 'attributes', 'events', 'start', 'duration', 'error', '_token', '_clock')
+
+    def __init__(self, tracer, name, parent, sampled, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else f'{random.getrandbits(64):016x}'
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent.span_id if parent is not None else None
+        self.sampled = sampled
+        self.attributes = attributes
+        self.events = []
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def rename(self, name):
+        self.name = name
+
+    def event(self, name, **attributes):
+        """Records something that happened ``offset`` seconds into the span."""
+        if self.sampled:
+            attributes['offset'] = time.perf_counter() - self._clock
+            attributes['name'] = name
+            self.events.append(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._clock = time.perf_counter()
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._clock
+        current_span.reset(self._token)
+        if exc is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+        if self.sampled:
+            self.tracer.write(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'error': self.error,
+            'attributes': self.attributes,
+            'events': self.events
+        }
+
+class _NoSpan:
+    """Stands in for a span while tracing is off."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def rename(self, name):
+        pass
+
+    def event(self, name, **attributes):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+class _TracedRequest:
+    def __init__(self, manager):
+        self.manager = manager
+
+    async def __aenter__(self):
+        span = current_span.get()
+        start = time.perf_counter()
+        response = await self.manager.__aenter__()
+        if span is not None:
+            span.event('attempt', status=response.status, seconds=time.perf_counter() - start)
+        return response
+
+    async def __aexit__(self, *exc):
+        return await self.manager.__aexit__(*exc)
+
+class _TracedSession:
+    """Wraps the HTTP client's session to record every attempt of a request.
+
+    discord.py waits for the rate limit bucket and retries 429s inside
+    ``HTTPClient.request``, so the attempts are the only way to split a
+    request's time into waiting and network time.
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, method, url, **kwargs):
+        return _TracedRequest(self.session.request(method, url, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+class Tracer:
+    """Writes spans of commands, listeners and REST requests as JSON lines.
+
+    Every command invocation and listener call starts a trace; REST requests
+    made while it runs become its child spans, with the time spent waiting for
+    the rate limit bucket, in 429 retries and on the network. ``sample_rate``
+    is the fraction of traces that are kept.
+    """
+    def __init__(self, bot, path=None, sample_rate=1.0):
+        self.bot = bot
+        self.path = None
+        self.sample_rate = sample_rate
+        self._file = None
+        self._install()
+        self.configure(path, sample_rate)
+
+    def configure(self, path=None, sample_rate=None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if path != self.path:
+            self.close()
+            self.path = path
+            if path is not None:
+                self._file = open(path, 'a', buffering=1)
+
+    @property
+    def enabled(self):
+        return self._file is not None and self.sample_rate > 0
+
+    def span(self, name, *, root=False, **attributes):
+        """Returns a context manager timing ``name`` as a child of the current span.
+
+        With ``root`` a new trace is started, even if a span is current.
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        parent = None if root else current_span.get()
+        if parent is None:
+            sampled = random.random() < self.sample_rate
+        else:
+            sampled = parent.sampled
+        return Span(self, name, parent, sampled, attributes)
+
+    def write(self, span):
+        try:
+            self._file.write(json.dumps(span.to_dict(), default=str) + '\n')
+        except (OSError, ValueError) as e:
+            print(f'Could not write trace to {self.path}: {e}')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _install(self):
+        http = self.bot.http
+        request = http.request
+        async def traced_request(route, **kwargs):
+            if not self.enabled or current_span.get() is None:
+                return await request(route, **kwargs)
+            session = http._HTTPClient__session
+            if session is not None and not isinstance(session, _TracedSession):
+                # The session is created on login and again on reconnect.
+                http._HTTPClient__session = _TracedSession(session)
+            with self.span('http', method=route.method, route=route.path, bucket=route.bucket) as span:
+                try:
+                    return await request(route, **kwargs)
+                finally:
+                    self._summarize(span)
+        http.request = traced_request
+
+    def _summarize(self, span):
+        if not span.sampled:
+            return
+        attempts = [e for e in span.events if e['name'] == 'attempt']
+        if not attempts:
+            return
+        network = sum(a['seconds'] for a in attempts)
+        bucket_wait = attempts[0]['offset'] - attempts[0]['seconds']
+        elapsed = time.perf_counter() - span._clock
+        span.set(
+            status=attempts[-1]['status'],
+            attempts=len(attempts),
+            bucket_wait=bucket_wait,
+            network=network,
+            retry_wait=max(0.0, elapsed - bucket_wait - network)
+        )
+
+def get_tracer(bot):
+    """Returns the tracer attached to ``bot``, creating it if needed."""
+    tracer = getattr(bot, 'tracer', None)
+    if tracer is None:
+        tracer = bot.tracer = Tracer(bot)
+    return tracer
@@ -1,9 +1,27 @@
 # util.py
 from discord.ext import commands
 import discord
+import time
 
-from cogfactory import make_cog, GroupCog
+from archive import get_archive
 from colors import random_color
+from loopmonitor import get_loop_monitor
+from purge import ChannelPurge
+from reconcile import get_reconciler
+from registry import get_registry
+from store import get_store
+from teardown import plan_teardown
+from throttle import throttled
+
+async def send_plan(ctx, lines):
+    """Sends the lines of a plan as code blocks, or says there is nothing to do."""
+    if not lines:
+        return await ctx.send('Nothing to do.')
+    paginator = commands.Paginator()
+    for line in lines:
+        paginator.add_line(line[:1900])
+    for page in paginator.pages:
+        await ctx.send(page)
 
 class Util(commands.Cog, name='Util'):
     def __init__(self, bot):
@@ -14,77 +32,114 @@ class Util(commands.Cog, name='Util'):
 
     @commands.command(
         name='clear-msgs',
-        help='Clears all messages in channel.',
+        help='Clears all messages in channel.\n'
+             'An interrupted clear resumes where it stopped; pass `restart` to start over.',
         description='Clears all messages in channel.'
     )
-    async def clear_msgs(self, ctx):
-        channel = ctx.channel
-        await channel.purge()
+    @throttled(cost=2, concurrency=2)
+    async def clear_msgs(self, ctx, mode=''):
+        purge = ChannelPurge(ctx.channel, get_store(self.bot))
+        if mode == 'restart':
+            purge.restart()
+        verb = 'Resuming clearing' if purge.resumed else 'Clearing'
+        status = await ctx.send(f'{verb} messages...')
+        async def progress(purge):
+            await status.edit(content=f'{verb} messages... {purge.deleted} deleted ({purge.old} older than 14 days)')
+        await purge.run(status, progress=progress)
+
+        content = f'Deleted {purge.deleted} messages'
+        if purge.old:
+            content += f', {purge.old} of them one by one since they were older than 14 days'
+        content += '.'
+        if purge.failed:
+            content += f'\nFailed to delete {len(purge.failed)} messages or batches: {purge.failed[0][1]}'
+        await status.edit(content=content[:2000])
 
     @commands.command(
         name='clear-groups',
-        help='Clears all categories, channels, and roles associated with groups.',
+        help='Clears all categories, channels, and roles associated with groups.\n'
+             'Text channels are archived first unless `no-archive` is passed.\n'
+             'Pass `dry-run` to only list what would be deleted.',
         description='Clears all groups, channels, and roles associated with groups.'
     )
-    async def clear_groups(self, ctx):
+    @throttled(cost=None)
+    async def clear_groups(self, ctx, mode=''):
         guild = ctx.guild
-        names = ''
-        # Go through cogs
-        cogs = list(filter(lambda c: isinstance(c[1], GroupCog), self.bot.cogs.items()))
-        for c in cogs:
-            name = c[1].name
-            cat = discord.utils.get(guild.categories, id=c[1].group_id)
-            for _c in cat.channels:
-                await _c.delete()
-            await cat.delete()
-            member_role = discord.utils.get(guild.roles, name=f'{name} Member')
-            if member_role:
-                await member_role.delete()
-            gm_role = discord.utils.get(guild.roles, name=f'{name} GM')
-            if gm_role:
-                await gm_role.delete()
-            if not names:
-                names = name
-            else:
-                names += f', {name}'
-            self.bot.remove_cog(c[0])
+        registry = get_registry(self.bot)
+        plan = plan_teardown(guild, registry)
+        if mode in ('dry-run', 'dry', 'plan'):
+            return await send_plan(ctx, plan.describe())
+
+        total = len(plan)
+        status = await ctx.send(f'Clearing {len(plan.names)} groups ({total} channels and roles)...')
+        async def progress(plan):
+            try:
+                await status.edit(content=f'Clearing {len(plan.names)} groups... {plan.done}/{total}')
+            except discord.NotFound:
+                # The command was run in a channel that has just been deleted.
+                pass
+        archive = get_archive(self.bot) if mode != 'no-archive' else None
+        await plan.run(registry, progress=progress, archive=archive)
+
+        content = f'Deleted channels: {", ".join(plan.group_names)}'
+        if plan.archived:
+            content += f'\nArchived {sum(plan.archived.values())} messages from {len(plan.archived)} channels to `{archive.root}`.'
+        if plan.failed:
+            content += f'\nFailed to delete {len(plan.failed)}: ' + ', '.join(o.name for o, e in plan.failed)
+        try:
+            await status.edit(content=content[:2000])
+        except discord.NotFound:
+            pass
 
-        # Go through category channels
-        for c in guild.categories:
-            name = c.name
-            for _c in c.channels:
-                await _c.delete()
-            await c.delete()
-            member_role = discord.utils.get(guild.roles, name=f'{name} Member')
-            if member_role:
-                await member_role.delete()
-            gm_role = discord.utils.get(guild.roles, name=f'{name} GM')
-            if gm_role:
-                await gm_role.delete()
-            if not names:
-                names = name
-            else:
-                names += f', {name}'
+    @commands.command(
+        name='loop-lag',
+        help='Shows event loop lag and the commands and listeners that blocked it the longest.\n'
+             'Pass `reset` to start over.',
+        description='Shows event loop lag and the slowest recent steps.'
+    )
+    async def loop_lag(self, ctx, mode=''):
+        monitor = get_loop_monitor(self.bot)
+        if mode == 'reset':
+            monitor.reset()
+            return await ctx.send('Event loop lag history cleared.')
+        paginator = commands.Paginator()
+        summary = monitor.summary()
+        if summary:
+            paginator.add_line(
+                'Lag over the last minute: '
+                + ', '.join(f'{k} {v * 1000:.1f}ms' for k, v in summary.items())
+            )
+        else:
+            paginator.add_line('The loop monitor is not running.')
+        paginator.add_line(f'Steps over {monitor.threshold * 1000:.0f}ms by source:')
+        by_label = sorted(monitor.by_label.items(), key=lambda i: i[1][2], reverse=True)
+        for label, (count, total, worst) in by_label[:10]:
+            paginator.add_line(f'  {worst * 1000:>8.1f}ms max {total * 1000:>9.1f}ms total {count:>5}x  {label}'[:1900])
+        paginator.add_line('Slowest steps:')
+        for step in monitor.worst():
+            when = time.strftime('%H:%M:%S', time.gmtime(step.when))
+            paginator.add_line(f'  {step.lag * 1000:>8.1f}ms {when}  {step.label} at {step.where}'[:1900])
+        for page in paginator.pages:
+            await ctx.send(page)
 
-        # Go through roles
-        for r in list(filter(lambda r: r.name.endswith('Member'), guild.roles)):
-            name = r.name.replace(' Member', '')
-            await r.delete()
-            gm_role = discord.utils.get(guild.roles, name=f'{name} GM')
-            if gm_role:
-                await gm_role.delete()
-            if not names:
-                names = name
-            else:
-                names += f', {name}'
-        for r in list(filter(lambda r: r.name.endswith('GM'), guild.roles)):
-            name = r.name.replace(' GM', '')
-            await r.delete()
-            if not names:
-                names = name
-            else:
-                names += f', {name}'
-        await ctx.send(f'Deleted channels: {names}')
+    @commands.command(
+        name='reconcile',
+        help='Repairs the roles and permissions of the groups in this guild.\n'
+             'Pass `dry-run` to only list what would be changed.',
+        description='Repairs group roles and permissions.'
+    )
+    @throttled(cost=5)
+    async def reconcile(self, ctx, mode=''):
+        reconciler = get_reconciler(self.bot)
+        if mode == 'dry-run':
+            return await send_plan(ctx, reconciler.plan(ctx.guild).describe())
+        async with ctx.typing():
+            plan = await reconciler.run(ctx.guild)
+        lines = []
+        if len(plan):
+            lines.append(f'Made {plan.done - len(plan.failed)} changes, {len(plan.failed)} failed.')
+            lines.extend(f'  {description}: {e}' for description, e in plan.failed)
+        await send_plan(ctx, lines)
 
 def setup(bot):
     bot.add_cog(Util(bot))